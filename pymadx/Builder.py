@@ -153,15 +153,10 @@ class Machine(object):
         return s
 
     def __iter__(self):
-        self._iterindex = -1
-        return self
-
-    def next(self):
-        if self._iterindex == len(self.sequence)-1:
-            raise StopIteration
-        self._iterindex += 1
-        return self.elementsd[self.sequence[self._iterindex]]
-        
+        # a new iterator each time so loops can be nested
+        for name in self.sequence:
+            yield self.elementsd[name]
+
     def __getitem__(self,name):
         if _IsFloat(name):
             return self.elementsd[self.sequence[name]]
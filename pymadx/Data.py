@@ -2,16 +2,43 @@
 Classes to load and manipulate data from MADX.
 """
 
+import ast as _ast
 import bisect as _bisect
+import bz2 as _bz2
 import copy as _copy
+import glob as _glob
+import gzip as _gzip
+import itertools as _itertools
+import mmap as _mmap
+import multiprocessing as _multiprocessing
 import numpy as _np
+import operator as _operator
 import re as _re
 import string as _string
 import tarfile
+import threading as _threading
 import os.path
-
+try:
+    from collections.abc import Mapping as _Mapping
+except ImportError:
+    from collections import Mapping as _Mapping # python 2
+try:
+    import queue as _queue
+except ImportError:
+    import Queue as _queue # python 2
+try:
+    import lzma as _lzma
+except ImportError:
+    _lzma = None # python 2
+
+from . import _Cache
+from ._Cache import SetCacheDirectory, SetCacheMaxSize, ClearCache
 from ._General import GetSixTrackAperType as _GetSixTrackAperType
-from ._General import Cast as _Cast
+
+try:
+    _stringTypes = (str, unicode) # python 2
+except NameError:
+    _stringTypes = (str,)
 
 class Tfs(object):
     """
@@ -25,6 +52,8 @@ class Tfs(object):
 
     >>> a = Tfs("myfile.tfs")
     >>> b = Tfs("myfile.tar.gz")
+    >>> c = Tfs(open("myfile.tfs")) -> any iterable of lines, read once
+    >>> d = Tfs(pathlib.Path("myfile.tfs")) -> or any other path-like object
 
     | `a` has data members:
     | header      - dictionary of header items
@@ -49,21 +78,24 @@ class Tfs(object):
     """
     # The Tfs class data model:
     # The NAME column for a given row refers to the name of the
-    # accelerator component.  Each row is stored in a dictionary,
-    # self.data, with the mangled NAME as a key, and the row as the
-    # entry.  The names must be mangled as they are in general not
-    # unique.  Dictionaries are not ordered, so the sequence of these
-    # mangled names is stored in self.sequence.  Two accelerator
-    # components with identical names in the sequence will be
-    # identical, but the optical functions at that point will in
-    # general be different.
+    # accelerator component.  Each column is stored as one typed numpy
+    # array in self._columndata, keyed by the column name, so a row is
+    # simply a common index into these arrays.  The names must be
+    # mangled as they are in general not unique.  The sequence of these
+    # mangled names is stored in self.sequence in the same order as the
+    # rows and self._RowIndex() maps each mangled name to its row.  Two
+    # accelerator components with identical names in the sequence will
+    # be identical, but the optical functions at that point will in
+    # general be different.  self.data is a dictionary-like view of the
+    # rows keyed by mangled name, kept for compatibility.
     def __init__(self,filename=None,**kwargs):
         object.__init__(self) #this allows type comparison for this class
-        self.index       = []
         self.header      = {}
         self.columns     = []
         self.formats     = []
-        self.data        = {}
+        self._columndata = _LazyColumns()
+        self._rowindex   = {}
+        self._namecount  = {}
         self.sequence    = []
         self.nitems      = 0
         self.nsegments   = 0
@@ -74,10 +106,30 @@ class Tfs(object):
         self._verbose    = False
         if 'verbose' in kwargs:
             self._verbose = kwargs['verbose']
-        if type(filename) == str:
-            self.Load(filename, self._verbose)
+        if _Filename(filename) is not None:
+            self.filename = _Filename(filename)
+            self.Load(self.filename, self._verbose, kwargs.get('cache', False),
+                      kwargs.get('lazy', False), kwargs.get('columns', None),
+                      kwargs.get('member', None))
         elif type(filename) == Tfs:
             self._DeepCopy(filename)
+        elif filename is not None:
+            # an open file, stream or other iterable of lines
+            self.filename = _Filename(getattr(filename, 'name', None))
+            self.Load(filename, self._verbose, columns=kwargs.get('columns', None))
+
+    @property
+    def data(self):
+        """
+        Dictionary-like view of the rows keyed by (mangled) name.  Each
+        row is a list-like object that reads from and writes to the
+        column arrays.
+        """
+        return _TfsRows(self)
+
+    @property
+    def index(self):
+        return list(range(self.nitems))
 
     def Clear(self):
         """
@@ -85,151 +137,329 @@ class Tfs(object):
         """
         self.__init__()
 
-    def Load(self, filename, verbose=False):
+    def Load(self, filename, verbose=False, cache=False, lazy=False, columns=None,
+             member=None):
         """
         >>> a = Tfs()
         >>> a.Load('filename.tfs')
 
-        Read the tfs file and prepare data structures. If 'tar' or 'gz are in
-        the filename, the file will be opened still compressed.
+        Read the tfs file and prepare data structures. A file compressed with
+        gzip, bzip2 or xz, or a tar archive (compressed or not), is recognised
+        from its contents and decompressed while it is read without any
+        temporary files.  member is the name of the file to read in a tar
+        archive, by default the first.
+
+        filename may also be any iterable of lines, such as an open file,
+        a pipe or a member of a tar file, which is read once from start
+        to end without seeking.
+
+        If cache is True, the parsed data is kept in a binary cache and
+        later loads of the same unchanged file memory-map it instead of
+        parsing the text again.  See SetCacheDirectory and SetCacheMaxSize.
+
+        If lazy is True, an uncompressed file is memory-mapped and only the
+        positions of the items on each line are found when loading.  Each
+        column is then converted to an array on its first use (e.g. by
+        GetColumn or accessing a row) and kept.  This is ignored if cache
+        is True or the file is compressed.
+
+        If columns is a list of column names, only these columns (and NAME,
+        which the rows are keyed by) are loaded and the others are never
+        converted or stored.  Calculated columns such as SMID or SIGMAX are
+        only added if the columns they need were loaded.
+        """
+        if _Filename(filename) is None:
+            self._ReadLines(filename, verbose, columns)
+            return
+        filename = _Filename(filename)
+
+        cachekey = ','.join(columns) if columns is not None else ''
+        if member is not None:
+            cachekey += '|member=' + member # each file in an archive is cached separately
+        if cache:
+            cached = _Cache.Load(filename, cachekey)
+            if cached is not None:
+                print('pymadx.Tfs.Load> cached file')
+                self._SetCacheState(*cached)
+                return
+
+        if lazy and not cache and not _IsCompressed(filename) and os.path.getsize(filename) > 0:
+            print('pymadx.Tfs.Load> mapped file')
+            self._LoadMapped(filename, verbose, columns)
+            return
+
+        f = _OpenTfsFile(filename, member)
+        try:
+            self._ReadLines(f, verbose, columns)
+        finally:
+            f.close()
+
+        if cache:
+            _Cache.Save(filename, cachekey, *self._GetCacheState())
+
+    def _GetCacheState(self):
+        """
+        Return the data of this instance as a dictionary of everything but
+        the numeric columns and a dictionary of the numeric column arrays.
+        """
+        meta = {'header'   : self.header,
+                'columns'  : self.columns,
+                'formats'  : self.formats,
+                'sequence' : self.sequence,
+                'segments' : self.segments,
+                'smin'     : self.smin,
+                'smax'     : self.smax}
+        arrays = {}
+        objectcolumns = {}
+        for column in self.columns:
+            values = self._columndata[column]
+            if values.dtype == object:
+                objectcolumns[column] = list(values)
+            else:
+                arrays[column] = values
+        meta['objectcolumns'] = objectcolumns
+        return meta, arrays
+
+    def _SetCacheState(self, meta, arrays):
+        self.header    = meta['header']
+        self.columns   = meta['columns']
+        self.formats   = meta['formats']
+        self.sequence  = meta['sequence']
+        self.segments  = meta['segments']
+        self.nsegments = len(self.segments)
+        self.nitems    = len(self.sequence)
+        self.smin      = meta['smin']
+        self.smax      = meta['smax']
+        self._columndata = _LazyColumns(arrays)
+        for column,values in meta['objectcolumns'].items():
+            self._columndata[column] = _ColumnArray(values, '%s')
+        self._UpdateRowIndex()
+        self.names = self.columns
+
+    def _ReadLines(self, lines, verbose=False, columns=None):
         """
-        if ('tar' in filename) or ('gz' in filename):
-            print('pymadx.Tfs.Load> zipped file')
-            tar = tarfile.open(filename,'r')
-            f = tar.extractfile(tar.firstmember)
-        else:
-            print('pymadx.Tfs.Load> normal file')
-            f = open(filename)
-
-        #first pass at file - need to check if it has 'NAME' column
-        #if it has name, use that, otherwise use an integer
-        #find column names line
-        for line in f:
-            if not line.strip():
-                continue #protection against empty lines being misidentified as column lines
-            sl = line.strip('\n').split()
-            if line[0] == '*':
-                #name
-                self.columns.extend(sl[1:]) #miss "*" from column names line
-                if verbose:
-                    print('Columns will be:')
-                    print(self.columns)
-                break
-        if 'NAME' in self.columns:
-            usename = True #use the name
+        Parse an iterable of lines of a tfs file in a single pass.
+        Whether rows are keyed by their name or by an integer index is
+        decided on reaching the column names line, before any data.
+        """
+        parser = _TfsParser(lines, verbose)
+        self._LoadBlocks(parser, parser.IterBlocks(_parseBlockSize), columns=columns)
+
+    def _LoadMapped(self, filename, verbose=False, columns=None):
+        """
+        Load an uncompressed tfs file leaving each column to be converted
+        from the memory-mapped text on its first use.  Only the names (and
+        S for the derived columns) are converted straight away.
+        """
+        text = _TfsText(filename, verbose)
+        self.header    = dict(text.parser.header)
+        indices        = self._SelectColumns(text.parser, columns)
+        self.segments  = list(text.segments)
+        self.nsegments = len(self.segments)
+
+        self._columndata['SEGMENT']     = _ColumnArray(text.segmentnumbers, '%d')
+        self._columndata['SEGMENTNAME'] = _ColumnArray(text.segmentnames, '%s')
+        formats = self.formats[2:] + [None]*(len(self.columns) - len(self.formats))
+        loaders = {}
+        for i,column,fmt in zip(indices, self.columns[2:], formats):
+            loaders[column] = lambda i=i, fmt=fmt: text.Column(i, fmt)
+            self._columndata.Defer([column], lambda load=loaders[column]: [load()])
+
+        if text.parser.usename:
+            self._ExtendSequence(self._columndata['NAME'], True)
         else:
-            usename = False #no name column - use an index
-        self.columns =  [] #reset columns for proper data read in
-        f.seek(0) #reset file back to the beginning for reading in data
+            self._ExtendSequence(range(len(text)), False)
+        self._AddDerivedColumns(0, text.parser.columns, loaders)
 
-        #segment specific stuff
-        segment_i = 0 #actual segment number in data may not be zero counting - use this variable
-        segment_name = 'NA'
-        #always include segments - put as first column in data
-        self.columns.append("SEGMENT")
-        self.formats.append("%d")
-        self.columns.append("SEGMENTNAME")
-        self.formats.append("%s")
-
-        namecolumnindex = 0
-
-        def CastAndStrip(arg):
-            argCast = _Cast(arg)
-            if type(argCast) == str:
-                #print argCast
-                argCast = argCast.strip('"') # strip unnecessary quote marks off
-                #print argCast
-            return argCast
-
-        #read in data
-        for line in f:
-            if not line.strip():
-                continue #protect against empty lines, although they should not exist
-            splitline = line.strip('\n').split()
-            sl        = splitline #shortcut
-            if line[0] == '@':
-                # Header
-                self.header[sl[1]] = CastAndStrip(sl[-1])
-            elif line[0] == '*':
-                #name
-                self.columns.extend(sl[1:]) #miss *
-                if "NAME" in self.columns:
-                    namecolumnindex = self.columns.index("NAME")
-            elif line[0] == '$':
-                #format
-                self.formats.extend(sl[1:]) #miss $
-            elif '#' in line[0]:
-                #segment line
-                d = [CastAndStrip(item) for item in sl[1:]]
-                segment_i    = d[0]
-                segment_name = d[-1]
-                self.nsegments += 1 # keep tally of number of segments
-                self.segments.append(segment_name)
+    def _SelectColumns(self, parser, columns=None):
+        """
+        Set the columns and formats of this instance to those read by
+        parser, keeping only those in columns (all if None) along with the
+        segment columns and NAME.  Returns the position on a data line of
+        each column kept.
+        """
+        filecolumns = parser.columns[2:]
+        if columns is None:
+            indices = list(range(len(filecolumns)))
+        else:
+            missing = [c for c in columns if c not in filecolumns]
+            if missing:
+                raise ValueError("Columns not in file: " + ", ".join(missing))
+            keep = set(columns) | set(['NAME'])
+            indices = [i for i,c in enumerate(filecolumns) if c in keep]
+        self.columns = parser.columns[:2] + [filecolumns[i] for i in indices]
+        self.formats = parser.formats[:2] + [parser.formats[2+i] for i in indices
+                                             if 2+i < len(parser.formats)]
+        return indices
+
+    def _LoadBlocks(self, parser, blocks, sstart=0, columns=None):
+        """
+        Fill this empty instance using the header, columns and formats
+        read by parser and the data in blocks, an iterable of blocks as
+        yielded by _TfsParser.IterBlocks.  Each block is converted to
+        column arrays before the next is read.  sstart is the S at the
+        start of the first row, used for SMID.  Only the columns in
+        columns are kept if it isn't None.
+        """
+        self.header = dict(parser.header)
+        indices     = self._SelectColumns(parser, columns)
+
+        arrays         = []
+        segmentnumbers = []
+        segmentnames   = []
+        for rows,numbers,names,segments in blocks:
+            arrays.append(self._ParseBlock(rows, parser.usename, indices))
+            segmentnumbers.extend(numbers)
+            segmentnames.extend(names)
+            self.segments.extend(segments)
+        self.nsegments = len(self.segments) # keep tally of number of segments
+        if not arrays:
+            arrays.append(self._ParseBlock([], parser.usename, indices))
+
+        self._columndata['SEGMENT']     = _ColumnArray(segmentnumbers, '%d')
+        self._columndata['SEGMENTNAME'] = _ColumnArray(segmentnames, '%s')
+        for i,column in enumerate(self.columns[2:]):
+            if len(arrays) == 1:
+                self._columndata[column] = arrays[0][i]
             else:
-                #data
-                d = [CastAndStrip(item) for item in sl]
-                d.insert(0,segment_name) #prepend segment info
-                d.insert(0,segment_i) #this one becomes the first item matching the column index
-                if usename:
-                    name = self._CheckName(d[namecolumnindex])
-                else:
-                    name = self.nitems
-                self.sequence.append(name) # keep the name in sequence
-                self.data[name] = d        # put in data dict by name
-                self.nitems += 1           # keep tally of number of items
+                self._columndata[column] = _np.concatenate([b[i] for b in arrays])
+        self._AddDerivedColumns(sstart, parser.columns)
 
-        f.close()
-
-        #additional processing
-        self.index = range(0,len(self.data),1)
+    def _AddDerivedColumns(self, sstart=0, filecolumns=(), loaders=None):
+        """
+        Add the columns calculated from those loaded.  sstart is the S at
+        the start of the first row, used for SMID.  filecolumns are all the
+        columns in the file, including any not loaded.  Any Sixtrack style
+        APERTYPE is only calculated on first use, as are the beam sizes if
+        loaders, a dictionary of column name to a function converting that
+        column from the file, is given (see _CalculateSigma).
+        """
         if 'S' in self.columns:
-            self.smin = self[0]['S']
-            self.smax = self[-1]['S']
-            sindex = self.ColumnIndex('S')
-            sEnd = self.GetColumn('S')  #calculating the mid points as the element
-            sEnd = _np.insert(sEnd,0,0)
+            s = self._columndata['S']
+            if len(s):
+                self.smin = s[0]
+                self.smax = s[-1]
+            else:
+                self.smax = 0 # e.g. a segment where all particles are lost
+            sEnd = _np.insert(s,0,sstart) #calculating the mid points as the element
             sMid = (sEnd[:-1] + sEnd[1:])/2
 
-            for i, name in enumerate(self.sequence):
-                self.data[name].append(self.data[name][sindex]) # copy S to SORIGINAL
-                self.data[name].append(sMid[i])
-                self.data[name].append(name)
-            self.columns.append('SORIGINAL')
-            self.formats.append('%le')
-            self.columns.append('SMID')
-            self.formats.append('%le')
+            self._AddColumn('SORIGINAL', '%le', s.copy()) # copy S to SORIGINAL
+            self._AddColumn('SMID', '%le', sMid)
             # Additional column which is just the name used to define
             # the sequence in self.sequence.
-            self.columns.append("UNIQUENAME")
-            self.formats.append("%s")
+            self._AddColumn('UNIQUENAME', '%s', self.sequence)
             assert len(set(self.GetColumn("UNIQUENAME"))) == len(self)
 
         else:
             self.smax = 0
 
         #Check to see if input Tfs is Sixtrack style (i.e no APERTYPE, and is instead implicit)
-        if 'APER_1' in self.columns and 'APERTYPE' not in self.columns:
-            self.columns.append('APERTYPE')
-            self.formats.append('%s')
+        apercolumns = set(['APER_1', 'APER_2', 'APER_3', 'APER_4'])
+        if apercolumns.issubset(self.columns) and 'APERTYPE' not in filecolumns:
+            def CalculateAperType():
+                apers = [self._columndata['APER_%d' % n] for n in range(1,5)]
+                apertypes = [_GetSixTrackAperType(a1,a2,a3,a4) for a1,a2,a3,a4 in zip(*apers)]
+                return [_ColumnArray(apertypes, '%s')]
+            self._AddDeferredColumns(['APERTYPE'], ['%s'], CalculateAperType)
+
+        self._CalculateSigma(loaders)
+        self.names = self.columns
 
-            for key, element in self.data.iteritems():
-                aper1 = element[self.columns.index('APER_1')]
-                aper2 = element[self.columns.index('APER_2')]
-                aper3 = element[self.columns.index('APER_3')]
-                aper4 = element[self.columns.index('APER_4')]
-                apertype = _GetSixTrackAperType(aper1,aper2,aper3,aper4)
+    def _ParseBlock(self, rows, usename, indices):
+        """
+        Convert a block of data rows, each a list of the string items on
+        a line, to a list of arrays - one per column kept, at the positions
+        indices on a line - using the column formats.  The rows are added
+        to the sequence.
+        """
+        formats = self.formats[2:] # skip the segment columns
+        if rows and len(indices) < len(rows[0]):
+            columns = [[row[i] for row in rows] for i in indices]
+        else:
+            columns = list(zip(*rows)) if rows else [()]*len(indices)
+        formats = formats + [None]*(len(columns) - len(formats))
+        arrays  = [_ParseColumn(items,fmt) for items,fmt in zip(columns,formats)]
 
-                element.append(apertype)
+        if usename:
+            names = arrays[self.columns.index('NAME') - 2]
+        else:
+            names = range(self.nitems, self.nitems + len(rows))
+        self._ExtendSequence(names, usename)
+        return arrays
+
+    def _ExtendSequence(self, names, mangle):
+        """
+        Append rows called names to the sequence, making each name unique
+        first if mangle is True.
+        """
+        names    = list(names)
+        rowindex = self._RowIndex()
+        if mangle and len(set(names)) == len(names) and not any(map(rowindex.__contains__, names)):
+            mangle = False # all unique already, so add them in one go
+        if not mangle:
+            rowindex.update(zip(names, range(self.nitems, self.nitems + len(names))))
+            self.sequence.extend(names)
+            self.nitems += len(names)
+            return
+        for name in names:
+            name = self._CheckName(name)
+            rowindex[name] = self.nitems
+            self.sequence.append(name) # keep the name in sequence
+            self.nitems += 1           # keep tally of number of items
 
-        self._CalculateSigma()
-        self.names = self.columns
+    def _AddColumn(self, name, fmt, values):
+        """
+        Append a column called name with TFS format fmt holding values,
+        which must have one entry per row.
+        """
+        self.columns.append(name)
+        self.formats.append(fmt)
+        self._columndata[name] = _ColumnArray(values, fmt)
 
-    def _CalculateSigma(self):
+    def _AddDeferredColumns(self, names, fmts, function):
+        """
+        Append columns called names with TFS formats fmts that are only
+        calculated when one of them is first used.  function is then called
+        with no arguments and must return a list of one array per column.
+        """
+        self.columns.extend(names)
+        self.formats.extend(fmts)
+        self._columndata.Defer(names, function)
+
+    def _CalculateSigma(self, loaders=None):
+        """
+        Add the beam size columns (see _SigmaParameters).  If loaders is
+        given (see _AddDerivedColumns) they are only calculated on first
+        use from the columns as in the file, so are the same whatever is
+        changed before then.
+        """
         if 'GAMMA' not in self.header:
             self.header['BETA'] = 1.0 # assume super relativistic
         else:
             self.header['BETA'] = _np.sqrt(1.0 - (1.0/(self.header['GAMMA']**2)))
 
+        parameters = self._SigmaParameters()
+        if parameters is None:
+            return
+        names = parameters[0]
+        if loaders is not None:
+            def CalculateSigma():
+                optics = _LazyColumns() # only the columns used are converted
+                for column,load in loaders.items():
+                    optics.Defer([column], lambda load=load: [load()])
+                return _BeamSizes(optics, *parameters)
+            self._AddDeferredColumns(names, ['%le']*len(names), CalculateSigma)
+            return
+        for name,values in zip(names, _BeamSizes(self._columndata, *parameters)):
+            self._AddColumn(name, '%le', values)
+
+    def _SigmaParameters(self):
+        """
+        Return (names, ex, ey, sige, beta) for the beam size columns that
+        can be calculated from the columns and header (see _BeamSizes) or
+        None if there are none.
+        """
         # check this file has the appropriate variables else, return without calculating
         # use a set to check if all variables are in a given list easily
         requiredVariablesB1 = set(['DX', 'DY', 'BETX', 'BETY'])
@@ -246,7 +476,7 @@ class Tfs(object):
         requiredVariablesH2 = set(['EXN', 'EYN', 'GAMMA'])
         method2 = requiredVariablesH2.issubset(self.header.keys())
         if not (method1 or method2):
-            return #no emittance information to calcualte sigma
+            return None #no emittance information to calcualte sigma
 
         if method1:
             ex   = self.header['EX']
@@ -257,68 +487,16 @@ class Tfs(object):
             ey   = self.header['EYN']*self.header['GAMMA']
             sige = 0
 
-        #if not requiredVariablesH.issubset(self.header.keys()):
-        #    return
-
         if not (calculateSpace or calculatePrime):
-            return # can't calculate either
+            return None # can't calculate either
 
-        # get indices to the columns we'll need in the data
-        dxindex = -1
-        dyindex = -1
+        names = []
         if calculateSpace:
-            dxindex   = self.ColumnIndex('DX')
-            dyindex   = self.ColumnIndex('DY')
-
-        dpxindex  = -1
-        dpyindex  = -1
-        alfxindex = -1
-        alfyindex = -1
+            names.extend(['SIGMAX', 'SIGMAY'])
         if calculatePrime:
-            dpxindex = self.ColumnIndex('DPX')
-            dpyindex  = self.ColumnIndex('DPY')
-            alfxindex = self.ColumnIndex('ALFX')
-            alfyindex = self.ColumnIndex('ALFY')
-
-        betxindex = self.ColumnIndex('BETX')
-        betyindex = self.ColumnIndex('BETY')
-
-        # constants
-        #sige = self.header['SIGE']
-        beta = self.header['BETA'] # relativistic beta
-        #ex   = self.header['EX']
-        #ey   = self.header['EY']
-        newcolumns = []
-
-        if calculateSpace:
-            newcolumns.extend(['SIGMAX', 'SIGMAY'])
-            self.formats.extend(['%le','%le'])
-        if calculatePrime:
-            newcolumns.extend(['SIGMAXP', 'SIGMAYP'])
-            self.formats.extend(['%le','%le'])
-        self.columns.extend(newcolumns)
-
-        for elementname in self.sequence:
-            # beam size calculations (using relation deltaE/E = beta^2 * deltaP/P)
-            d = self.data[elementname]
-            if calculateSpace:
-                xdispersionterm = (d[dxindex] * sige / beta**2)**2
-                ydispersionterm = (d[dyindex] * sige / beta**2)**2
-                sigx = _np.sqrt((d[betxindex] * ex) + xdispersionterm)
-                sigy = _np.sqrt((d[betyindex] * ey) + ydispersionterm)
-                d.append(sigx)
-                d.append(sigy)
-
-            # beam divergences (using relation x',y' = sqrt(gamma_x,y * emittance_x,y))
-            if calculatePrime:
-                gammax = (1.0 + d[alfxindex]**2) / d[betxindex] # twiss gamma
-                gammay = (1.0 + d[alfyindex]**2) / d[betyindex]
-                xdispersionterm = (d[dpxindex] * sige / beta**2)**2
-                ydispersionterm = (d[dpyindex] * sige / beta**2)**2
-                sigxp  = _np.sqrt((gammax * ex) + xdispersionterm)
-                sigyp  = _np.sqrt((gammay * ey) + ydispersionterm)
-                d.append(sigxp)
-                d.append(sigyp)
+            names.extend(['SIGMAXP', 'SIGMAYP'])
+        beta = self.header.get('BETA', 1.0) # relativistic beta
+        return names, ex, ey, sige, beta
 
     def __repr__(self):
         if self.filename is not None:
@@ -331,14 +509,13 @@ class Tfs(object):
         return len(self.sequence)
 
     def __iter__(self):
-        self._iterindex = -1
-        return self
-
-    def next(self):
-        if self._iterindex == len(self.sequence)-1:
-            raise StopIteration
-        self._iterindex += 1
-        return self.GetRowDict(self.sequence[self._iterindex])
+        """
+        Iterate over the rows, each a read-only dictionary-like view of
+        the row keyed by column name (use dict(row) for a copy).  A new
+        iterator is made each time so loops can be nested.
+        """
+        for i in range(self.nitems):
+            yield _TfsRecord(self, i)
 
     def __getitem__(self,index):
         #index can be a slice object, string or integer - deal with in this order
@@ -348,6 +525,8 @@ class Tfs(object):
             #test values incase of ':' use
             if step != None and type(step) != int:
                 raise ValueError("Invalid step "+step)
+            if step == None:
+                step = 1
             if start != None and stop != None and step != None:
                 # [start:stop:step]
                 start = self._EnsureItsAnIndex(start)
@@ -391,33 +570,34 @@ class Tfs(object):
                 # [:stop:-step]
                 start = 0
                 stop  = self._EnsureItsAnIndex(stop)
-            index = slice(start,stop,step)
+            indices = range(start,stop,step)
             #construct and return a new instance of the class
             a = Tfs()
             a._CopyMetaData(self)
-
-            # whether to prepare new s coordinates as extra entry
-            prepareNewS = False
-            sOffset     = 0
-            if start > 0 and 'S' in self.columns:
-                prepareNewS = True
-                # note S is at the end of an element, so take the element before for offset ( start - 1 )
-                # if 'S' is in the columns, 'SORIGINAL' will be too
-                sOffset = self.GetRowDict(self.sequence[start-1])['SORIGINAL']
-                sOffsetMid = self.GetRowDict(self.sequence[start-1])['SMID']
-            # prepare S coordinate and append to each list per element
-            for i in range(index.start,index.stop,index.step):
-                elementlist = list(self.data[self.sequence[i]]) # copy instead of modify existing
-                if prepareNewS:
+            if len(indices) == 0 or (0 <= min(indices[0], indices[-1]) and
+                                     max(indices[0], indices[-1]) < len(self)):
+                # the same rows as a python slice, so share the columns
+                end = indices[-1] + step if len(indices) else start
+                a._ViewRows(self, slice(start, end if end >= 0 else None, step))
+            else:
+                a._ViewRows(self, _np.asarray(indices, dtype=int))
+
+            if 'S' in self.columns and len(a) > 0:
+                # prepare new s coordinates
+                s, sOffset = a._columndata['S'], 0.0
+                if start > 0:
+                    # note S is at the end of an element, so take the element before for offset ( start - 1 )
+                    # if 'S' is in the columns, 'SORIGINAL' will be too
                     # maintain the original s from the original data
-                    elementlist[self.ColumnIndex('S')] = elementlist[self.ColumnIndex('SORIGINAL')] - sOffset
-                    elementlist[self.ColumnIndex('SMID')] = elementlist[self.ColumnIndex('SMID')] - sOffsetMid
-                a._AppendDataEntry(self.sequence[i], elementlist)
-
-            a.smax = max(a.GetColumn('S'))
-            a.smin = min(a.GetColumn('S'))
+                    s          = a._columndata['SORIGINAL']
+                    sOffset    = self._columndata['SORIGINAL'][start-1]
+                    sOffsetMid = self._columndata['SMID'][start-1]
+                    a._columndata['S']    = s - sOffset
+                    a._columndata['SMID'] = a._columndata['SMID'] - sOffsetMid
+                # S increases along the sequence so the extremes are at the ends
+                a.smax = max(s[0], s[-1]) - sOffset
+                a.smin = min(s[0], s[-1]) - sOffset
             return a
-
         elif type(index) == int or type(index) == _np.int64:
             return self.GetRowDict(self.sequence[index])
         elif type(index) == str:
@@ -426,48 +606,98 @@ class Tfs(object):
             raise ValueError("argument not an index or a slice")
 
     def _CheckName(self,name):
-        if self.data.has_key(name):
+        rowindex = self._RowIndex()
+        if name in rowindex:
             #name already exists - boo degenerate names!
-            i = 1
+            #carry on from the last suffix tried for this name, as all
+            #those before it are taken, so each duplicate is O(1)
             basename = name
-            while self.data.has_key(name):
+            i = self._namecount.get(basename, 1)
+            while name in rowindex:
                 name = basename+'_'+str(i)
                 i = i + 1
+            self._namecount[basename] = i
             return name
         else:
             return name
 
     def _CopyMetaData(self,instance):
-        params = ["header","columns","formats","filename"]
-        for param in params:
-            setattr(self,param,getattr(instance,param))
+        self.header   = dict(instance.header)
+        self.columns  = list(instance.columns)
+        self.formats  = list(instance.formats)
+        self.filename = instance.filename
         #calculate the maximum s position - could be different based on the slice
-        if 'S' in instance.columns:
-            self.smax = instance[-1]['S']
+        if 'S' in instance.columns and len(instance) > 0:
+            self.smax = instance._columndata['S'][-1]
         else:
             self.smax = 0
 
+    def _ViewRows(self,instance,rows):
+        """
+        Fill this (empty) instance with the rows of instance selected by
+        the slice or integer array rows without copying them.  For a slice
+        the column arrays are views of those in instance, otherwise each
+        column is only gathered from instance's array when first used, as
+        is any column instance hasn't made yet.  Either instance copies a shared array only when changing it.
+        """
+        for column in instance.columns:
+            instance._columndata.Take(column, rows, self._columndata)
+        if isinstance(rows, slice):
+            self.sequence = instance.sequence[rows]
+        else:
+            self.sequence = [instance.sequence[i] for i in rows]
+        self.nitems   = len(self.sequence)
+        self._UpdateRowIndex()
+
+    def _UpdateRowIndex(self):
+        """
+        Mark the map of name to row as out of date after rows have been
+        inserted, removed or reordered.  It is made again on next use.
+        """
+        self._rowindex  = None
+        self._namecount = {} # names may have been removed
+
+    def _RowIndex(self):
+        """
+        Return the dictionary of (mangled) name to row index.
+        """
+        if self._rowindex is None:
+            self._rowindex = dict((name,i) for i,name in enumerate(self.sequence))
+        return self._rowindex
+
     def _DeepCopy(self,instance):
-        #return type(self)(deepcopy(instance))
+        """
+        Make this (empty) instance an independent copy of instance.  The
+        column arrays are shared and only copied by whichever instance
+        changes one first (see _ViewRows).
+        """
         self._CopyMetaData(instance)
-        params = ["index","data","sequence","nitems","nsegments"]
+        self._ViewRows(instance, slice(None))
+        params = ["nsegments","segments","smin"]
         for param in params:
             setattr(self,param,_copy.deepcopy(getattr(instance,param)))
 
     def _AppendDataEntry(self,name,entry):
-        if len(self.index) > 0:                   #check if there's any elements yet
-            self.index.append(self.index[-1] + 1) #create an index
-        else:
-            self.index.append(0)
+        for column,value in zip(self.columns,entry):
+            if column in self._columndata:
+                self._columndata[column] = _np.append(self._columndata[column], [value])
+            else:
+                fmt = self.formats[self.columns.index(column)]
+                self._columndata[column] = _ColumnArray([value], fmt)
+        self._RowIndex()[name] = self.nitems
         self.sequence.append(name)  #append name to sequence
         self.nitems    += 1         #increment nitems
-        self.data[name] = entry     #put the data in
 
     def __iadd__(self, other):
         self._CopyMetaData(other) #fill in any data from other instance
-        for i in range(len(other)):
-            key = other.sequence[i]
-            self._AppendDataEntry(key,other.data[key])
+        for column in other.columns:
+            values = other._columndata[column]
+            if column in self._columndata:
+                values = _np.concatenate((self._columndata[column], values))
+            self._columndata[column] = values.copy()
+        self.sequence.extend(other.sequence)
+        self.nitems = len(self.sequence)
+        self._UpdateRowIndex()
         return self
 
     def NameFromIndex(self,index):
@@ -483,9 +713,14 @@ class Tfs(object):
         NameFromNearestS(S)
 
         return the name of the beamline element clostest to S
+
+        S may also be an array of positions, in which case a list of
+        names is returned.
         """
 
         i = self.IndexFromNearestS(S)
+        if _np.ndim(i) > 0:
+            return [self.sequence[j] for j in i]
         return self.sequence[i]
 
     def IndexFromNearestS(self, S):
@@ -495,27 +730,96 @@ class Tfs(object):
         return the index of the beamline element which CONTAINS the
         position S.
 
+        S may also be an array of positions, in which case an array of
+        indices is returned.  This is a binary search of the S column.
+
         Note:  For small values beyond smax, the index returned will
         be -1 (i.e. the last element).
 
         """
-        if S > self.smax and S < self.smax + 10:
-            # allow some margin (+10) in case point is only just beyond the
-            # beam line.  This is purely for clicking the plotted the machine
-            # along the top of a figure.
-            return -1
-        elif S > self.smax + 10:
-            raise ValueError("S is out of bounds.")
-        elif S < self.smin:
+        positions = _np.asarray(S, dtype=float)
+        # allow some margin (+10) in case point is only just beyond the
+        # beam line.  This is purely for clicking the plotted the machine
+        # along the top of a figure.
+        if _np.any(positions > self.smax + 10) or _np.any(positions < self.smin):
             raise ValueError("S is out of bounds.")
 
-        for i in range(1, self.nitems + 1):
-            sLow = self[i - 1]['S']
-            sHigh = self[i]['S']
+        # first element whose S (at its end) is beyond the position
+        indices = _np.searchsorted(self._columndata['S'], positions, side='right')
+        indices = _np.where(indices >= self.nitems, -1, indices)
+        if indices.ndim == 0:
+            return int(indices)
+        return indices
+
+    def InterpolateAt(self, S, columns=None):
+        """
+        Return a dictionary of column name to the values of that column at
+        each of the positions S (a number or an array).  All columns are
+        given if columns isn't.
+
+        As S is at the end of each element, values at a position are made
+        from the row of the element that contains it and the row before
+        (the element's start).  Within drifts the twiss parameters, phase
+        advance, dispersion and orbit are propagated from the start of the
+        drift as in free space.  Other numerical columns, and all in other
+        elements, are interpolated linearly.  Beam sizes are calculated
+        from the interpolated optics.  Integer and text columns give the
+        value of the element containing the position.
+
+        >>> optics = a.InterpolateAt(losses, ['BETX', 'DX', 'SIGMAX'])
+        """
+        columns = list(self.columns if columns is None else columns)
+        for column in columns:
+            self.ColumnIndex(column) # raises ValueError if not present
+        positions = _np.asarray(S, dtype=float)
+        s = self._columndata['S']
+        if len(s) == 0 or _np.any(positions < s[0]) or _np.any(positions > s[-1]):
+            raise ValueError("S is out of bounds.")
+        # rows at the end and start of the element containing each position
+        # (the search is much faster with the positions in order)
+        order  = _np.argsort(positions, axis=None)
+        end    = _np.empty(positions.shape, dtype=int)
+        end.flat[order] = _np.searchsorted(s, positions.flat[order], side='left')
+        end    = _np.minimum(end, len(s)-1)
+        start  = _np.maximum(end - 1, 0)
+        d      = positions - s[start]
+        length = s[end] - s[start]
+        fraction = _np.where(length > 0, d / _np.where(length > 0, length, 1.0), 0.0)
+        drift = _np.zeros(len(self), dtype=bool)
+        if 'KEYWORD' in self.columns:
+            drift[self._columndata.RowsByValue('KEYWORD').get('DRIFT', [])] = True
+        drift = drift[end] & (end != start)
+
+        entries = {}
+        def Entry(column):
+            if column not in self.columns:
+                raise KeyError(column)
+            if column not in entries:
+                entries[column] = self._columndata[column][start]
+            return entries[column]
+
+        def Value(column):
+            values = self._columndata[column]
+            if values.dtype.kind != 'f':
+                value = values[end]
+            else:
+                value = Entry(column) + (values[end] - Entry(column)) * fraction
+                driftValue = _DriftValue(column, Entry, d)
+                if driftValue is not None:
+                    value = _np.where(drift, driftValue, value)
+            return value
 
-            if (S >= sLow and S < sHigh):
-                return i
-        raise ValueError("S is out of bounds.")
+        result = {}
+        sigmas = self._SigmaParameters()
+        if sigmas is not None and set(sigmas[0]).intersection(columns):
+            optics = dict((column,Value(column)) for column in
+                          ['BETX', 'BETY', 'ALFX', 'ALFY', 'DX', 'DY', 'DPX', 'DPY']
+                          if column in self.columns)
+            result.update(zip(sigmas[0], _BeamSizes(optics, *sigmas)))
+        for column in columns:
+            if column not in result:
+                result[column] = Value(column)
+        return dict((column,result[column]) for column in columns)
 
     def _EnsureItsAnIndex(self, value):
         if type(value) == str:
@@ -529,7 +833,10 @@ class Tfs(object):
         ValueError if not found.
 
         """
-        return self.sequence.index(namestring)
+        try:
+            return self._RowIndex()[namestring]
+        except KeyError:
+            raise ValueError("{} is not in the sequence".format(namestring))
 
     def ColumnIndex(self,columnstring):
         """
@@ -544,10 +851,14 @@ class Tfs(object):
     def GetColumn(self,columnstring):
         """
         Return a numpy array of the values in columnstring in order
-        as they appear in the beamline
+        as they appear in the beamline.  This is a read only view of
+        the stored column rather than a copy.
         """
-        i = self.ColumnIndex(columnstring)
-        return _np.array([self.data[name][i] for name in self.sequence])
+        self.ColumnIndex(columnstring) # raises ValueError if not present
+        # a read only view so the stored data can't be changed by accident
+        column = self._columndata[columnstring].view()
+        column.flags.writeable = False
+        return column
 
     def GetColumnDict(self,columnstring):
         """
@@ -556,8 +867,8 @@ class Tfs(object):
 
         note not in order
         """
-        i = self.ColumnIndex(columnstring)
-        d = dict((k,v[i]) for (k,v) in self.data.iteritems())
+        self.ColumnIndex(columnstring) # raises ValueError if not present
+        d = dict(zip(self.sequence, self._columndata[columnstring]))
         #note we construct the dictionary comprehension in a weird way
         #here because SL6 uses python2.6 which doesn't have dict comprehension
         return d
@@ -581,19 +892,62 @@ class Tfs(object):
         note not in order
         """
         #no dictionary comprehension in python2.6 on SL6
-        d = dict(zip(self.columns,self.data[elementname]))
+        i = self._RowIndex()[elementname]
+        d = dict((column,self._columndata[column][i]) for column in self.columns)
         return d
 
-    def GetSegment(self,segmentnumber):
+    def Select(self, mask):
+        """
+        Return a Tfs instance with only the rows selected by mask, which
+        may be a boolean array of one value per row, a sequence of integer
+        row indices or a slice.
+
+        >>> a.Select(a.GetColumn('BETX') > 100)
+        >>> a.Select(a.GetColumn('KEYWORD') == 'QUADRUPOLE').Select(...)
+
+        The columns aren't copied.  Each is only gathered from this
+        instance's when first used, so repeated selections only cost the
+        columns that are looked at.
+        """
+        if type(mask) != slice:
+            mask = _np.asarray(mask)
+            if mask.dtype == bool:
+                if len(mask) != len(self):
+                    raise ValueError("Mask of length "+str(len(mask))+" for "+str(len(self))+" rows")
+                mask = _np.flatnonzero(mask)
+            else:
+                mask = mask.astype(int)
         a = Tfs()
         a._CopyMetaData(self)
-        segmentindex = self.columns.index('SEGMENT')
-        hasname = 'NAME' in self.columns
-        for key in self.sequence:
-            if self.data[key][segmentindex] == segmentnumber:
-                a._AppendDataEntry(key,self.data[key])
+        a._ViewRows(self, mask)
         return a
 
+    def Query(self, expression):
+        """
+        Return a Tfs instance with only the rows for which expression is
+        true (see Select).  expression is a Python expression in which
+        column names stand for all values of that column and header keys
+        for that value.  It may use comparisons, 'in' and 'not in' with a
+        tuple or list, 'and', 'or', 'not', arithmetic and the functions
+        abs, sqrt, exp, log, log10, sin, cos, tan, min and max
+        (element-wise).
+
+        >>> a.Query("KEYWORD in ('QUADRUPOLE','SBEND') and S > 1000 and abs(K1L) > 0")
+
+        The expression is evaluated for all rows at once.
+        """
+        try:
+            tree = _ast.parse(expression.strip(), mode='eval')
+        except SyntaxError:
+            raise ValueError("Invalid query '"+expression+"'")
+        mask = _np.asarray(_QueryValue(self, tree.body), dtype=bool)
+        if mask.ndim == 0:
+            mask = _np.full(len(self), bool(mask))
+        return self.Select(mask)
+
+    def GetSegment(self,segmentnumber):
+        return self.Select(self._RowsWhere('SEGMENT', lambda value: value == segmentnumber))
+
     def EditComponent(self, index, variable, value):
         '''
         Edits variable of component at index and sets it to value.  Can
@@ -601,9 +955,8 @@ class Tfs(object):
         a unique definition, and components which may appear
         degenerate/reused are in fact not in this data model.
         '''
-        variableIndex = self.columns.index(variable)
-        componentName = self.sequence[index]
-        self.data[componentName][variableIndex] = value
+        self.ColumnIndex(variable) # raises ValueError if not present
+        self._columndata.Writable(variable)[index] = value
 
     def InterrogateItem(self,itemname):
         """
@@ -612,8 +965,9 @@ class Tfs(object):
         Print out all the parameters and their names for a
         particlular element in the sequence identified by name.
         """
-        for i,parameter in enumerate(self.columns):
-            print(parameter.ljust(10,'.'),self.data[itemname][i])
+        i = self._RowIndex()[itemname]
+        for parameter in self.columns:
+            print(parameter.ljust(10,'.'),self._columndata[parameter][i])
 
     def GetElementNamesOfType(self,typename):
         """
@@ -629,13 +983,26 @@ class Tfs(object):
         >>> GetElementsOfType(('SBEND','RBEND','QUADRUPOLE'))
 
         """
+        return [self.sequence[i] for i in self._IndicesOfType(typename)]
+
+    def _IndicesOfType(self,typename):
         if 'KEYWORD' in self.columns:
-            i = self.ColumnIndex('KEYWORD')
+            column = 'KEYWORD'
         elif 'APERTYPE' in self.columns:
-            i = self.ColumnIndex('APERTYPE')
+            column = 'APERTYPE'
         else:
-            i = 0
-        return [name for name in self.sequence if self.data[name][i] in typename]
+            column = self.columns[0]
+        return self._RowsWhere(column, lambda value: value in typename)
+
+    def _RowsWhere(self, column, test):
+        """
+        Return the array of rows in increasing order whose value in column
+        passes test.  test is called once per distinct value.
+        """
+        rows = [r for value,r in self._columndata.RowsByValue(column).items() if test(value)]
+        if len(rows) == 1:
+            return rows[0]
+        return _np.sort(_np.concatenate(rows)) if rows else _np.zeros(0, dtype=int)
 
     def GetElementsOfType(self,typename):
         """
@@ -644,12 +1011,7 @@ class Tfs(object):
 
         This returns a Tfs instance with all the same capabilities as this one.
         """
-        names = self.GetElementNamesOfType(typename)
-        a = Tfs()
-        a._CopyMetaData(self)
-        for key in names:
-            a._AppendDataEntry(key,self.data[key])
-        return a
+        return self.Select(self._IndicesOfType(typename))
 
     def GetCollimators(self):
         """
@@ -657,16 +1019,11 @@ class Tfs(object):
         and ECOLLIMATOR)
         """
         if 'KEYWORD' in self.columns:
-            i = self.ColumnIndex('KEYWORD')
+            column = 'KEYWORD'
         else:
-            i = 0
+            column = self.columns[0]
 
-        names = [name for name in self.sequence if 'COLLIMATOR' in self.data[name][i]]
-        a = Tfs()
-        a._CopyMetaData(self)
-        for key in names:
-            a._AppendDataEntry(key,self.data[key])
-        return a
+        return self.Select(self._RowsWhere(column, lambda value: 'COLLIMATOR' in value))
 
     def GetElementsWithTextInName(self, text):
         """
@@ -676,19 +1033,17 @@ class Tfs(object):
         This returns a Tfs instance with all the same capabilities as this one.
 
         """
-        a = Tfs()
-        a._CopyMetaData(self)
-        for item in self.sequence:
-            if type(text) == str:
-                if text in item:
-                    a._AppendDataEntry(item, self.data[item])
-            elif type(text) == list:
-                for t in text:
-                    if t in item:
-                        a._AppendDataEntry(item, self.data[item])
-            else:
-                pass
-        return a
+        if type(text) == str:
+            text = [text]
+        elif type(text) != list:
+            text = []
+        if not text:
+            return self.Select([])
+        # one search per name for any of the strings
+        pattern = _re.compile('|'.join(_re.escape(t) for t in text))
+        mask = _np.fromiter((pattern.search(name) is not None for name in self.sequence),
+                            dtype=bool, count=len(self))
+        return self.Select(mask)
 
     def ReportPopulations(self):
         """
@@ -698,14 +1053,14 @@ class Tfs(object):
         print('Filename >',self.filename)
         print('Total number of items >',self.nitems)
         if 'KEYWORD' in self.columns:
-            i = self.ColumnIndex('KEYWORD')
+            column = 'KEYWORD'
         elif 'APERTYPE' in self.columns:
-            i = self.ColumnIndex('APERTYPE')
+            column = 'APERTYPE'
         else:
             raise KeyError("No keyword or apertype columns in this Tfs file")
 
-        keys = set([self.data[name][i] for name in self.sequence])
-        populations = [(len(self.GetElementsOfType(key)),key) for key in keys]
+        rows = self._columndata.RowsByValue(column)
+        populations = [(len(r),key) for key,r in rows.items()]
         print('Type'.ljust(15,'.'),'Population')
         for item in sorted(populations)[::-1]:
             print(item[1].ljust(15,'.'),item[0])
@@ -749,15 +1104,7 @@ class Tfs(object):
         gmadname     :    The gmad name of a component to search for.
         verbose      :    prints out matching name indices and S locations.  Useful for discriminating between identical names.
         '''
-        indices = []
-        #Because underscores are allowed in gmad names:
-        punctuation = _string.punctuation.replace('_', '')
-        for index, element in enumerate(self):
-            #translate nothing to nothing and delete all forbidden chars from name.
-            name = element['NAME']
-            strippedName = name.translate(_string.maketrans("",""), punctuation)
-            if _re.match(gmadname + "_?[0-9]*", strippedName):
-                indices.append(index)
+        indices = self.IndicesFromGmadNames([gmadname])[0]
         if verbose:
             for index in indices:
                 sPos = self.data[self.NameFromIndex(index)][self.ColumnIndex('S')]
@@ -769,6 +1116,33 @@ class Tfs(object):
         else:
             raise ValueError(gmadname + ' not found in list')
 
+    def IndicesFromGmadNames(self, gmadnames):
+        '''
+        Returns a list of the indices of the elements which match each of
+        the supplied gmad names (see IndexFromGmadName), with an empty list
+        for a name that isn't found.  The punctuation is removed from all
+        names in the file once and kept, and plain names are found by a
+        binary search of them, so many names can be resolved at once.
+        '''
+        stripped, order, ordered = self._columndata.Derived('NAME', 'gmad', _GmadNameIndex)
+        gmadnames = list(gmadnames)
+        # a plain gmad name matches the stripped names it is a prefix of,
+        # which sort between it and the next string of the same length
+        plain  = [bool(_re.match(r'\w+$', gmadname)) for gmadname in gmadnames]
+        first  = [g for g,p in zip(gmadnames, plain) if p]
+        after  = [g[:-1] + chr(ord(g[-1]) + 1) for g in first]
+        starts = iter(_np.searchsorted(ordered, first, side='left')) if first else iter([])
+        ends   = iter(_np.searchsorted(ordered, after, side='left')) if first else iter([])
+        result = []
+        for gmadname,isplain in zip(gmadnames, plain):
+            if isplain:
+                indices = _np.sort(order[next(starts):next(ends)]).tolist()
+            else:
+                pattern = _re.compile(gmadname + "_?[0-9]*")
+                indices = [i for i,name in enumerate(stripped) if pattern.match(name)]
+            result.append(indices)
+        return result
+
     def ExpandThinMagnets(self):
         '''
         expand hkickers and vkickers.  not particularly useful or dynamic,
@@ -943,9 +1317,61 @@ class Tfs(object):
             or new in self.GetColumn("UNIQUENAME")):
             raise ValueError("New name already present: {}".format(new))
         self.sequence[index] = new
-        self.data[old][self.ColumnIndex("NAME")] = new
-        self.data[old][self.ColumnIndex("UNIQUENAME")] = new
-        self.data[new] = self.data.pop(old)
+        self._columndata.Writable("NAME")[index] = new
+        self._columndata.Writable("UNIQUENAME")[index] = new
+        rowindex = self._RowIndex()
+        rowindex[new] = rowindex.pop(old)
+        self._namecount = {}
+
+    def RenameElements(self, renames):
+        """
+        Rename many elements at once.  renames is either a dictionary of
+        (mangled) name or index to new name, or a function that is called
+        with each name in the sequence and returns its new name (or the
+        same name to leave it unchanged).
+
+        Every new name is checked before any element is renamed.  As with
+        RenameElement, a ValueError is raised if a new name is already
+        present in the sequence, NAME or UNIQUENAME of an element that
+        isn't renamed, or is given to more than one element.  Elements
+        may swap names.
+        """
+        if callable(renames):
+            changed = [(i,renames(name)) for i,name in enumerate(self.sequence)]
+            changed = [(i,new) for i,new in changed if new != self.sequence[i]]
+        else:
+            changed = [(range(self.nitems)[self._EnsureItsAnIndex(key)], new)
+                       for key,new in renames.items()]
+        if not changed:
+            return
+        rows = [i for i,_ in changed]
+        news = [new for _,new in changed]
+        if len(set(rows)) != len(rows):
+            raise ValueError("Element renamed more than once")
+        if len(set(news)) != len(news):
+            raise ValueError("New name given to more than one element")
+
+        # names of the elements that keep theirs
+        kept = _np.ones(self.nitems, dtype=bool)
+        kept[rows] = False
+        present = set(name for name,k in zip(self.sequence, kept) if k)
+        for column in ['NAME', 'UNIQUENAME']:
+            if column in self.columns:
+                present.update(self._columndata[column][kept])
+        clashes = [new for new in news if new in present]
+        if clashes:
+            raise ValueError("New name already present: {}".format(clashes[0]))
+
+        rowindex = self._RowIndex()
+        for i in rows:
+            del rowindex[self.sequence[i]]
+        for i,new in changed:
+            self.sequence[i] = new
+        rowindex.update(zip(news, rows))
+        for column in ['NAME', 'UNIQUENAME']:
+            if column in self.columns:
+                self._columndata.Writable(column)[rows] = news
+        self._namecount = {}
 
     def SplitElement(self, SSplit):
         '''Splits the element found at SSplit given, performs the necessary
@@ -962,69 +1388,105 @@ class Tfs(object):
         YOUR LATTICE.  YOUR OPTICS WILL BE WRONG!
 
         '''
+        return self.SplitElements([SSplit])[0]
+
+    def SplitElements(self, SSplits):
+        '''Splits the elements at each of the positions SSplits in one
+        go, leaving the model functionally identical as SplitElement
+        does.  An element split n times becomes n+1 elements named as
+        the original appended with "_split_1" to "_split_<n+1>" in
+        order of S.  L is divided at the split points and HKICK and
+        VKICK in proportion to the length of each part.
+
+        Returns a list of the indices of the components either side of
+        each split point (first, second) in order of increasing S.
+        Repeated split points are only split once.  ValueError is raised
+        if a split point is outside the lattice, at or beyond its end or
+        in an element of zero length.
 
-        # the element to be split:
-        originalIndex = self.IndexFromNearestS(SSplit)
-        originalName = self.sequence[originalIndex]
-        originalLength = self[originalName]['L']
-        originalS = self[originalName]['S']
-        originalHKick = self[originalName]['HKICK']
-        originalVKick = self[originalName]['VKICK']
-        elementType = self[originalName]['KEYWORD']
-
-        # First of the two elements that the original is split into.
-        # Remembering that in MADX S is at the end of the component.
-        firstS = SSplit
-        firstLength = originalLength - (originalS - SSplit)
-        firstName = originalName + str("_split_1")
-        firstUniqueName = firstName
-        firstIndex = originalIndex
-
-        # second of two elements that original is split into:
-        secondS = originalS
-        secondLength = originalS - SSplit
-        secondName = originalName + str("_split_2")
-        secondUniqueName = secondName
-        secondIndex = originalIndex + 1
-
-        # update the sequence
-        self.sequence[firstIndex] = firstName
-        self.sequence.insert(secondIndex, secondName)
-
-        # Making data entries for new components
-        self.data[firstName] = _copy.deepcopy(self.data[originalName])
-        self.data[secondName] = _copy.deepcopy(self.data[originalName])
-        del self.data[originalName]
-
-        # Apply the relevant edits to the newly split component.
-        self.EditComponent(firstIndex, 'L', firstLength)
-        self.EditComponent(firstIndex, 'S', firstS)
-        self.EditComponent(firstIndex, 'SMID', firstS - firstLength/2.0)
-        self.EditComponent(firstIndex, 'SORIGINAL', originalS)
-        self.EditComponent(firstIndex, 'NAME', firstName)
-        self.EditComponent(firstIndex, 'UNIQUENAME', firstUniqueName)
-
-        self.EditComponent(secondIndex, 'L', secondLength)
-        self.EditComponent(secondIndex, 'S', secondS)
-        self.EditComponent(secondIndex, 'SMID', secondS - secondLength/2.0)
-        self.EditComponent(secondIndex, 'SORIGINAL', originalS)
-        self.EditComponent(secondIndex, 'NAME', secondName)
-        self.EditComponent(secondIndex, 'UNIQUENAME', secondUniqueName)
-
-        # Assign the appropriate amount of kick to each of the two components
-        ratio = firstLength/originalLength
-        self.EditComponent(firstIndex, 'HKICK', ratio * originalHKick)
-        self.EditComponent(firstIndex, 'VKICK', ratio * originalVKick)
-        self.EditComponent(secondIndex, 'HKICK', (1 - ratio) * originalHKick)
-        self.EditComponent(secondIndex, 'VKICK', (1 - ratio) * originalVKick)
-
-        assert self[secondName]["S"] == originalS
-        assert self[firstName]["L"] + self[secondName]["L"] == originalLength
-        assert (self[firstName]["HKICK"]
-                + self[secondName]["HKICK"]) == originalHKick
-        assert (self[firstName]["VKICK"]
-                + self[secondName]["VKICK"]) == originalVKick
-        return firstIndex, secondIndex
+        WARNING: DO NOT SPLIT THE ELEMENT WHICH MARKS THE BEGINNING OF
+        YOUR LATTICE.  YOUR OPTICS WILL BE WRONG!
+
+        '''
+        positions = _np.unique(_np.asarray(SSplits, dtype=float).ravel())
+        if len(positions) == 0:
+            return []
+        if positions[0] < self.smin or positions[-1] >= self.smax:
+            raise ValueError("S is out of bounds.")
+
+        s = self._columndata['S']
+        l = self._columndata['L']
+        # the element containing each split point (as IndexFromNearestS)
+        elements = _np.searchsorted(s, positions, side='right')
+        elements = _np.minimum(elements, self.nitems - 1)
+        if _np.any(l[elements] == 0):
+            raise ValueError("Can't split a zero length element at S = " +
+                             str(positions[l[elements] == 0][0]))
+        # each element becomes one part more than the splits in it
+        counts = _np.bincount(elements, minlength=self.nitems) + 1
+        rows   = _np.repeat(_np.arange(self.nitems), counts)
+        starts = _np.cumsum(counts) - counts # new index of the first part of each
+        # get every column first as deferred ones are calculated from the others
+        values = [self._columndata[column] for column in self.columns]
+        for column,v in zip(self.columns, values):
+            self._columndata[column] = v[rows]
+
+        # the parts of the split elements in the new rows, each with its
+        # number r in the element and the split points before and after it
+        parts  = _np.flatnonzero(counts[rows] > 1)
+        e      = rows[parts]
+        r      = parts - starts[e]
+        last   = r == counts[e] - 1
+        after  = _np.searchsorted(elements, e) + r
+        before = after - 1
+        after  = _np.minimum(after, len(positions) - 1)
+        sEnd, lOriginal = s[e], l[e]
+        group  = _np.cumsum(r == 0) - 1 # the split element of each part
+        def Conserve(values, original):
+            # give the last part of each element what the others leave of
+            # original, so the parts add up to it exactly in order
+            earlier = _np.zeros(_np.count_nonzero(last))
+            for i in range(r.max()):
+                summed = (r == i) & ~last
+                earlier[group[summed]] += values[summed]
+            values[last] = original[last] - earlier
+            return values
+        # as SplitElement the length left after each split point is
+        # S - SSplit and the parts are the differences of these
+        remainingAfter  = _np.where(last, 0.0, sEnd - positions[after])
+        remainingBefore = _np.where(r > 0, sEnd - positions[before], lOriginal)
+        lengths = Conserve(remainingBefore - remainingAfter, lOriginal)
+        sParts  = _np.where(last, sEnd, positions[after])
+        self._columndata.Writable('L')[parts] = lengths
+        self._columndata.Writable('S')[parts] = sParts
+        if 'SMID' in self.columns:
+            self._columndata.Writable('SMID')[parts] = sParts - lengths/2.0
+        if 'SORIGINAL' in self.columns:
+            self._columndata.Writable('SORIGINAL')[parts] = sEnd
+
+        # kicks in proportion to length through the element so they sum
+        # to the original as with SplitElement
+        fractionAfter  = _np.where(last, 1.0, (lOriginal - remainingAfter)/lOriginal)
+        fractionBefore = _np.where(r > 0, (lOriginal - remainingBefore)/lOriginal, 0.0)
+        for column in ['HKICK', 'VKICK']:
+            if column in self.columns:
+                kicks = self._columndata.Writable(column)
+                kicks[parts] = Conserve((fractionAfter - fractionBefore) * kicks[parts],
+                                        kicks[parts])
+
+        sequence = [self.sequence[i] for i in rows]
+        for i,part in zip(parts, r):
+            sequence[i] = sequence[i] + "_split_" + str(part + 1)
+        self.sequence = sequence
+        self.nitems   = len(sequence)
+        for column in ['NAME', 'UNIQUENAME']:
+            if column in self.columns:
+                values = self._columndata.Writable(column)
+                values[parts] = [sequence[i] for i in parts]
+        self._UpdateRowIndex()
+
+        firsts = starts[elements] + _np.arange(len(positions)) - _np.searchsorted(elements, elements)
+        return [(int(i), int(i) + 1) for i in firsts]
 
     def WrapAroundElement(self, item):
         '''
@@ -1035,42 +1497,869 @@ class Tfs(object):
         S and SMID are updated as necessary.
         '''
 
-        if isinstance(item, basestring):
+        if isinstance(item, str):
             index = self.IndexFromName(item)
         else:
             index = item
 
-        # Get the element which will be the new start's S and SMID
-        # values.  These will be used for updating all the other
-        # element's S and SMID.
-        newStartS = self[index]['S']
-        newStartSMid = self[index]['SMID']
-        # Have to change SORIGINAL otherwise slicing won't work:
-        newStartSOriginal = self[index]['SORIGINAL']
-        # Getting the sequences for the new first and second
-        # parts.
-        newStart = self.sequence[index:]
-        newEnd = self.sequence[:index]
+        index = range(self.nitems)[index] # raises IndexError as a list would
+        # get every column first as deferred ones are calculated from the others
+        values = dict((column, self._columndata[column]) for column in self.columns)
+        for column in self.columns:
+            values[column] = _np.roll(values[column], -index)
 
+        # Shift S, SMID and SORIGINAL (which has to change otherwise
+        # slicing won't work) so the new start is at zero and the
+        # elements that came before it follow on from the end.
         smax = self.smax
-        for i in range(index, len(self)):
-            elementS = self[i]['S']
-            elementSMid = self[i]['SMID']
-            elementSOriginal = self[i]['SORIGINAL']
-            self.EditComponent(i, 'S', elementS - newStartS)
-            self.EditComponent(i, 'SMID', elementSMid - newStartSMid)
-            self.EditComponent(i, 'SORIGINAL', elementSOriginal - newStartSOriginal)
-        for i in range(index):
-            elementS = self[i]['S']
-            elementSMid = self[i]['SMID']
-            elementSOriginal = self[i]['SORIGINAL']
-            self.EditComponent(i, 'S', elementS + (smax - newStartS))
-            self.EditComponent(i, 'SMID', elementSMid + (smax - newStartSMid))
-            self.EditComponent(i, 'SORIGINAL', elementSOriginal +
-                               (smax - newStartSOriginal))
+        end  = self.nitems - index
+        for column in ['S', 'SMID', 'SORIGINAL']:
+            if column in self.columns:
+                newStart = self._columndata[column][index]
+                shifted  = values[column]
+                shifted[:end] -= newStart
+                shifted[end:] += smax - newStart
 
         self.sequence = self.sequence[index:] + self.sequence[:index]
         self.sequence = self.sequence[0:-1]
+        for column in self.columns:
+            self._columndata[column] = values[column][0:-1]
+        self.nitems = len(self.sequence)
+        self._UpdateRowIndex()
+
+# number of data rows converted to column arrays at once when loading
+_parseBlockSize = 10000
+# number of bytes of a memory-mapped tfs file scanned for items at once
+_scanBlockSize = 4*1024**2
+
+# number of bytes decompressed at once and the number of these that can
+# be waiting to be parsed
+_readBlockSize = 1024**2
+_readQueueSize = 8
+
+# first bytes of each type of compressed file
+_magicNumbers = [(b'\x1f\x8b',         'gz'),
+                 (b'BZh',              'bz2'),
+                 (b'\xfd7zXZ\x00', 'xz')]
+
+def _Compression(filename):
+    """
+    Return the type of compression of filename ('gz', 'bz2', 'xz' or 'tar'
+    for a tar archive, possibly also compressed) from its contents, or None
+    for a plain file.
+    """
+    with open(filename, 'rb') as f:
+        start = f.read(8)
+    if tarfile.is_tarfile(filename):
+        return 'tar'
+    for magic,compression in _magicNumbers:
+        if start.startswith(magic):
+            return compression
+    return None
+
+def _Filename(filename):
+    """
+    Return filename as a string if it's the path to a file, i.e. a string
+    or a path-like object such as a pathlib.Path, or None otherwise (e.g.
+    for an open file or other iterable of lines).
+    """
+    if isinstance(filename, _stringTypes):
+        return filename
+    elif hasattr(filename, '__fspath__'):
+        return filename.__fspath__()
+    return None
+
+def _IsCompressed(filename):
+    return _Compression(filename) is not None
+
+def _OpenTfsFile(filename, member=None):
+    """
+    Open a tfs file for reading, which may be compressed (see _Compression).
+    In a tar archive the file named member is read, or the first file if
+    member is None.  Returns an iterable of lines that must be closed after
+    use.  Compressed files are decompressed in a background thread.
+    """
+    compression = _Compression(filename)
+    if compression is None:
+        print('pymadx.Tfs.Load> normal file')
+        return open(filename)
+
+    print('pymadx.Tfs.Load> ' + compression + ' compressed file')
+    if compression == 'tar':
+        tar = tarfile.open(filename, 'r|*') # stream so members are read in order
+        try:
+            for info in tar:
+                if info.isfile() and (member is None or info.name == member):
+                    return _BackgroundLines(tar.extractfile(info), [tar])
+        except:
+            tar.close()
+            raise
+        tar.close()
+        raise IOError("No file " + (member or "") + " in tar archive " + filename)
+    elif compression == 'gz':
+        stream = _gzip.GzipFile(filename, 'rb')
+    elif compression == 'bz2':
+        stream = _bz2.BZ2File(filename, 'rb')
+    elif _lzma is None:
+        raise IOError("The lzma module is required for xz compressed file " + filename)
+    else:
+        stream = _lzma.LZMAFile(filename, 'rb')
+    return _BackgroundLines(stream)
+
+class _BackgroundLines(object):
+    """
+    Iterable of the lines of a binary stream, such as a decompressing file.
+    The stream is read in a background thread in blocks that are passed
+    through a bounded queue, so decompression and parsing overlap.  close
+    stops the thread and closes the stream and the files in others.
+    """
+    def __init__(self, stream, others=()):
+        self._stream = stream
+        self._others = list(others)
+        self._queue  = _queue.Queue(_readQueueSize)
+        self._stop   = _threading.Event()
+        self._thread = _threading.Thread(target=self._Read)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _Put(self, item):
+        # give up if closed while the queue is full
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except _queue.Full:
+                pass
+
+    def _Read(self):
+        try:
+            while not self._stop.is_set():
+                block = self._stream.read(_readBlockSize)
+                if not block:
+                    break
+                self._Put(block)
+        except Exception as e:
+            self._Put(e) # raised again when reached by the parser
+            return
+        self._Put(None)
+
+    def __iter__(self):
+        rest = b''
+        while True:
+            block = self._queue.get()
+            if block is None:
+                break
+            elif isinstance(block, Exception):
+                raise block
+            lines = (rest + block).split(b'\n')
+            rest = lines.pop()
+            for line in lines:
+                yield line
+        if rest:
+            yield rest
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self._stream.close()
+        for f in self._others:
+            f.close()
+
+class _TfsParser(object):
+    """
+    Reads the header, column names and formats of a tfs file from an
+    iterable of lines on construction, stopping at the first data or
+    segment line.  The data is then read with IterBlocks.
+
+    If template (another _TfsParser for the same file) is given, its
+    header, columns and formats are reused and the header lines in
+    lines are skipped without being parsed.
+    """
+    def __init__(self, lines, verbose=False, template=None):
+        #always include segments - put as first column in data
+        self.header   = {}
+        self.columns  = ["SEGMENT", "SEGMENTNAME"]
+        self.formats  = ["%d", "%s"]
+        self.usename  = False #if no name column - use an index
+        self.ncolumns = 0     #number of items expected on each data line
+        if template is not None:
+            self.header   = template.header
+            self.columns  = template.columns
+            self.formats  = template.formats
+            self.usename  = template.usename
+            self.ncolumns = template.ncolumns
+
+        self._lines = iter(lines)
+        self._first = None # first data or segment line
+        for line in self._lines:
+            if not isinstance(line, str):
+                line = line.decode() # bytes from a binary stream or tar member
+            sl = line.split()
+            if not sl:
+                continue #protect against empty lines, although they should not exist
+            key = line[0]
+            if key not in '@*$':
+                self._first = line
+                break
+            elif template is not None:
+                continue
+            elif key == '@':
+                # Header
+                self.header[sl[1]] = _CastAndStrip(sl[-1])
+            elif key == '*':
+                #name
+                self.columns.extend(sl[1:]) #miss *
+                self.ncolumns = len(sl) - 1
+                if verbose:
+                    print('Columns will be:')
+                    print(self.columns)
+                self.usename = "NAME" in self.columns
+            elif key == '$':
+                #format
+                self.formats.extend(sl[1:]) #miss $
+
+    def IterBlocks(self, nrows=None, bysegment=False):
+        """
+        Read the data and yield it in blocks of at most nrows rows (no
+        limit if None).  If bysegment is True a new block is also started
+        at each segment line.  Each block is a tuple of:
+
+        rows           - list of data rows, each a list of the string items on the line
+        segmentnumbers - list of the segment number of each row
+        segmentnames   - list of the segment name of each row
+        segments       - list of the names of the segment lines read in this block
+        """
+        #segment specific stuff
+        segment_i = 0 #actual segment number in data may not be zero counting - use this variable
+        segment_name = 'NA'
+
+        rows           = []
+        segmentnumbers = []
+        segmentnames   = []
+        segments       = []
+        ncolumns       = self.ncolumns
+        lines = self._lines
+        if self._first is not None:
+            lines = _itertools.chain([self._first], lines)
+            self._first = None
+        for line in lines:
+            if not isinstance(line, str):
+                line = line.decode() # bytes from a binary stream or tar member
+            sl = line.split()
+            if not sl:
+                continue #protect against empty lines, although they should not exist
+            if line[0] == '#':
+                #segment line
+                if bysegment and (rows or segments):
+                    yield rows, segmentnumbers, segmentnames, segments
+                    rows, segmentnumbers, segmentnames, segments = [], [], [], []
+                d = [_CastAndStrip(item) for item in sl[1:]]
+                segment_i    = d[0]
+                segment_name = d[-1]
+                segments.append(segment_name)
+            else:
+                #data
+                if len(sl) != ncolumns:
+                    raise ValueError("Expected " + str(ncolumns) + " items on line: " + line)
+                rows.append(sl)
+                segmentnumbers.append(segment_i)
+                segmentnames.append(segment_name)
+                if len(rows) == nrows:
+                    yield rows, segmentnumbers, segmentnames, segments
+                    rows, segmentnumbers, segmentnames, segments = [], [], [], []
+        if rows or segments:
+            yield rows, segmentnumbers, segmentnames, segments
+
+class _TfsText(object):
+    """
+    The data lines of an uncompressed tfs file memory-mapped with the
+    position of every item on each line found once on construction, so
+    any one column can later be converted with Column without reading the
+    others.  The header is read with a _TfsParser, available as parser.
+
+    Members segments, segmentnumbers and segmentnames are as given by
+    _TfsParser.IterBlocks for the whole file.
+    """
+    def __init__(self, filename, verbose=False):
+        with open(filename, 'rb') as f:
+            self._map = _mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_READ)
+        self._buffer = _np.frombuffer(self._map, dtype=_np.uint8)
+
+        last = [b''] # the last line read, where the data starts
+        def Lines():
+            for line in iter(self._map.readline, b''):
+                last[0] = line
+                yield line
+        self.parser = _TfsParser(Lines(), verbose)
+        start = self._map.tell()
+        if self.parser._first is not None:
+            start -= len(last[0])
+
+        ncolumns   = self.parser.ncolumns
+        rowstarts  = []
+        itemstarts = []
+        itemends   = []
+        segmentstarts = []
+        self.segments = []
+        segmentnumbers = [0]
+        while start < len(self._buffer):
+            end = self._map.find(b'\n', start + _scanBlockSize)
+            end = len(self._buffer) if end < 0 else end + 1
+            rows, starts, ends, segmentlines = self._Scan(start, end, ncolumns)
+            rowstarts.append(rows)
+            itemstarts.append(starts)
+            itemends.append(ends)
+            for linestart in segmentlines:
+                linestart += start
+                line = self._Line(linestart)
+                d = [_CastAndStrip(item) for item in line.split()[1:]]
+                segmentstarts.append(linestart)
+                segmentnumbers.append(d[0])
+                self.segments.append(d[-1])
+            start = end
+
+        if rowstarts:
+            self._rowstarts  = _np.concatenate(rowstarts)
+            self._itemstarts = _np.concatenate(itemstarts)
+            self._itemends   = _np.concatenate(itemends)
+        else:
+            self._rowstarts  = _np.zeros(0, dtype=_np.int64)
+            self._itemstarts = _np.zeros((0,ncolumns), dtype=_np.uint32)
+            self._itemends   = _np.zeros((0,ncolumns), dtype=_np.uint32)
+        if len(self._itemends) and self._itemends.max() < 2**16:
+            self._itemstarts = self._itemstarts.astype(_np.uint16)
+            self._itemends   = self._itemends.astype(_np.uint16)
+
+        # the segment of each row is that of the last segment line before it
+        segment = _np.searchsorted(segmentstarts, self._rowstarts)
+        self.segmentnumbers = _np.array(segmentnumbers)[segment]
+        self.segmentnames   = _ColumnArray(['NA'] + self.segments, '%s')[segment]
+
+    def __len__(self):
+        return len(self._rowstarts)
+
+    def _Line(self, start):
+        end = self._map.find(b'\n', start)
+        line = self._map[start:end if end >= 0 else len(self._buffer)]
+        return line if isinstance(line, str) else line.decode()
+
+    def _Scan(self, start, end, ncolumns):
+        """
+        Find the items on the lines from byte start to end, which must both
+        be at the start of a line.  Returns the position of each data line
+        relative to start, the positions of the start and end of each item
+        relative to its line as arrays of shape (nrows, ncolumns) and the
+        positions of any segment lines relative to start.
+        """
+        chars  = self._buffer[start:end]
+        space  = _np.concatenate(([True], chars <= 32, [True])).view(_np.int8)
+        edges  = _np.diff(space)
+        starts = _np.flatnonzero(edges == -1) # each item starts after a space
+        ends   = _np.flatnonzero(edges == 1)  # and ends before one
+
+        linestarts = _np.flatnonzero(chars == 10) + 1
+        linestarts = _np.concatenate(([0], linestarts[linestarts < len(chars)]))
+        line    = _np.searchsorted(linestarts, starts, 'right') - 1
+        nitems  = _np.bincount(line, minlength=len(linestarts))
+        segment = (chars[linestarts] == ord('#')) & (nitems > 0)
+        data    = (~segment) & (nitems > 0) # empty lines are skipped
+        bad = _np.flatnonzero(data & (nitems != ncolumns))
+        if len(bad):
+            line = self._Line(start + linestarts[bad[0]])
+            raise ValueError("Expected " + str(ncolumns) + " items on line: " + line)
+
+        rows  = linestarts[data]
+        items = data[line]
+        starts = (starts[items] - _np.repeat(rows, ncolumns)).reshape(-1, ncolumns)
+        ends   = (ends[items] - _np.repeat(rows, ncolumns)).reshape(-1, ncolumns)
+        return (rows + start, starts.astype(_np.uint32), ends.astype(_np.uint32),
+                linestarts[segment])
+
+    def _Items(self, i, unquote=False):
+        """
+        Return the items in column i (counting from the first column in the
+        file) as an array of byte strings, without any quote marks around
+        them if unquote is True.
+        """
+        arrays = []
+        for r in range(0, len(self), _parseBlockSize):
+            rows    = slice(r, r + _parseBlockSize)
+            starts  = self._rowstarts[rows] + self._itemstarts[rows,i]
+            lengths = self._itemends[rows,i].astype(_np.int64) - self._itemstarts[rows,i]
+            if unquote:
+                quoted = ((self._buffer[starts] == ord('"')) &
+                          (self._buffer[starts + lengths - 1] == ord('"')) & (lengths > 1))
+                starts  = starts + quoted
+                lengths = lengths - 2*quoted
+            width = max(lengths.max(), 1)
+            offsets = _np.arange(width)
+            inside  = offsets < lengths[:,None]
+            chars   = _np.where(inside, starts[:,None] + offsets, 0)
+            chars   = _np.where(inside, self._buffer[chars], 0).astype(_np.uint8)
+            arrays.append(chars.view('S%d' % width).reshape(-1))
+        if not arrays:
+            return _np.zeros(0, dtype='S1')
+        return _np.concatenate(arrays)
+
+    def Column(self, i, fmt):
+        """
+        Convert column i (counting from the first column in the file) to a
+        numpy array as _ParseColumn does.
+        """
+        if fmt is None or not fmt.endswith('s'):
+            try:
+                return _ColumnArray(self._Items(i), fmt if fmt is not None else '%le')
+            except ValueError:
+                pass
+        items = self._Items(i, True)
+        if items.dtype.kind != _np.dtype(str).kind:
+            items = _np.char.decode(items, 'utf-8') # python 3
+        return items.astype(object)
+
+def _CastAndStrip(arg):
+    """
+    Cast to a float or if that doesn't work return the string without
+    quote marks. Data items are instead converted per column using the
+    formats from the $ line.
+    """
+    try:
+        return float(arg)
+    except ValueError:
+        return arg.strip('"') # strip unnecessary quote marks off
+
+def _ParseColumn(items, fmt):
+    """
+    Convert the string items of one column in a tfs file to a numpy array
+    according to its format from the $ line (e.g. %le, %d, %s).  Quote
+    marks are removed from strings.  If there is no format or the items
+    don't match it, the column is kept as strings.
+    """
+    if fmt is None or not fmt.endswith('s'):
+        try:
+            return _ColumnArray(items, fmt if fmt is not None else '%le')
+        except ValueError:
+            pass
+    return _ColumnArray([item.strip('"') for item in items], '%s')
+
+def _ColumnArray(values, fmt):
+    """
+    Return a numpy array of values with a type suited to the TFS column
+    format fmt (e.g. %le, %d, %s).  Strings are held in object arrays so
+    they are not truncated to a fixed width when edited.  If fmt is None
+    the type is float if possible and object otherwise.
+    """
+    if fmt is None:
+        try:
+            return _np.array(values, dtype=_np.float64)
+        except (ValueError, TypeError):
+            fmt = '%s'
+    if fmt.endswith('s'):
+        a = _np.empty(len(values), dtype=object)
+        a[:] = list(values)
+        return a
+    elif fmt.endswith('d'):
+        return _np.array(values, dtype=_np.float64).astype(_np.int64)
+    else:
+        return _np.array(values, dtype=_np.float64)
+
+_queryFunctions = {
+    'abs'   : _np.abs,
+    'sqrt'  : _np.sqrt,
+    'exp'   : _np.exp,
+    'log'   : _np.log,
+    'log10' : _np.log10,
+    'sin'   : _np.sin,
+    'cos'   : _np.cos,
+    'tan'   : _np.tan,
+    'min'   : _np.minimum,
+    'max'   : _np.maximum,
+}
+
+_queryOperators = {
+    _ast.Add   : _operator.add,
+    _ast.Sub   : _operator.sub,
+    _ast.Mult  : _operator.mul,
+    _ast.Div   : _operator.truediv,
+    _ast.Mod   : _operator.mod,
+    _ast.Pow   : _operator.pow,
+    _ast.Eq    : _operator.eq,
+    _ast.NotEq : _operator.ne,
+    _ast.Lt    : _operator.lt,
+    _ast.LtE   : _operator.le,
+    _ast.Gt    : _operator.gt,
+    _ast.GtE   : _operator.ge,
+}
+
+def _QueryValue(tfs, node):
+    """
+    Evaluate the parsed Tfs.Query expression node for all rows of tfs at
+    once.  Names are columns (arrays) or header keys.
+    """
+    if isinstance(node, _ast.BoolOp):
+        combine = _np.logical_and if isinstance(node.op, _ast.And) else _np.logical_or
+        result  = _QueryValue(tfs, node.values[0])
+        for value in node.values[1:]:
+            result = combine(result, _QueryValue(tfs, value))
+        return result
+    elif isinstance(node, _ast.UnaryOp):
+        value = _QueryValue(tfs, node.operand)
+        if isinstance(node.op, _ast.Not):
+            return _np.logical_not(value)
+        elif isinstance(node.op, _ast.USub):
+            return -value
+        elif isinstance(node.op, _ast.UAdd):
+            return value
+    elif isinstance(node, _ast.BinOp) and type(node.op) in _queryOperators:
+        left, right = _QueryValue(tfs, node.left), _QueryValue(tfs, node.right)
+        return _queryOperators[type(node.op)](left, right)
+    elif isinstance(node, _ast.Compare):
+        result = True
+        left   = _QueryValue(tfs, node.left)
+        for op,comparator in zip(node.ops, node.comparators):
+            right = _QueryValue(tfs, comparator)
+            if isinstance(op, (_ast.In, _ast.NotIn)):
+                if not isinstance(right, (tuple, list)):
+                    raise ValueError("'in' in a query needs a tuple or list of values")
+                value = False
+                for option in right:
+                    value = _np.logical_or(value, left == option)
+                if isinstance(op, _ast.NotIn):
+                    value = _np.logical_not(value)
+            elif type(op) in _queryOperators:
+                value = _queryOperators[type(op)](left, right)
+            else:
+                raise ValueError("Unsupported comparison in query")
+            result = _np.logical_and(result, value)
+            left   = right
+        return result
+    elif isinstance(node, _ast.Call):
+        if (not isinstance(node.func, _ast.Name) or node.func.id not in _queryFunctions
+            or node.keywords or getattr(node, 'starargs', None) or getattr(node, 'kwargs', None)):
+            raise ValueError("Unsupported function call in query")
+        arguments = [_QueryValue(tfs, argument) for argument in node.args]
+        return _queryFunctions[node.func.id](*arguments)
+    elif isinstance(node, _ast.Name) and node.id not in ('True', 'False', 'None'):
+        if node.id in tfs.columns:
+            return tfs._columndata[node.id]
+        elif node.id in tfs.header:
+            return tfs.header[node.id]
+        raise ValueError("Unknown column '"+node.id+"' in query")
+    try:
+        return _ast.literal_eval(node) # numbers, strings and tuples of them
+    except ValueError:
+        raise ValueError("Unsupported expression in query")
+
+def _BeamSizes(data, names, ex, ey, sige, beta):
+    """
+    Return a list of arrays of the beam sizes in names (SIGMAX, SIGMAY
+    and / or SIGMAXP, SIGMAYP) from the optics columns in the mapping data,
+    the emittances, the fractional energy spread and relativistic beta.
+    """
+    arrays = []
+    # beam size calculations (using relation deltaE/E = beta^2 * deltaP/P)
+    if 'SIGMAX' in names:
+        xdispersionterm = (data['DX'] * sige / beta**2)**2
+        ydispersionterm = (data['DY'] * sige / beta**2)**2
+        arrays.append(_np.sqrt((data['BETX'] * ex) + xdispersionterm))
+        arrays.append(_np.sqrt((data['BETY'] * ey) + ydispersionterm))
+
+    # beam divergences (using relation x',y' = sqrt(gamma_x,y * emittance_x,y))
+    if 'SIGMAXP' in names:
+        gammax = (1.0 + data['ALFX']**2) / data['BETX'] # twiss gamma
+        gammay = (1.0 + data['ALFY']**2) / data['BETY']
+        xdispersionterm = (data['DPX'] * sige / beta**2)**2
+        ydispersionterm = (data['DPY'] * sige / beta**2)**2
+        arrays.append(_np.sqrt((gammax * ex) + xdispersionterm))
+        arrays.append(_np.sqrt((gammay * ey) + ydispersionterm))
+    return arrays
+
+def _DriftValue(column, entry, d):
+    """
+    Return the value of the optical function column at distances d into
+    drifts from the values entry(name) of the columns at their starts, or
+    None if column isn't propagated through drifts or the columns it needs
+    aren't present (entry raises KeyError).
+    """
+    plane, kind = column[-1:], column[:-1]
+    if plane not in ('X', 'Y'):
+        return None
+    try:
+        if kind in ('BET', 'ALF', 'MU'):
+            beta0, alpha0 = entry('BET'+plane), entry('ALF'+plane)
+            gamma0 = (1.0 + alpha0**2) / beta0
+            if kind == 'BET':
+                return beta0 - 2*alpha0*d + gamma0*d**2
+            elif kind == 'ALF':
+                return alpha0 - gamma0*d
+            else:
+                # phase advance in units of 2 pi as in MADX
+                return entry(column) + _np.arctan2(d, beta0 - alpha0*d) / (2*_np.pi)
+        elif kind in ('D', ''):
+            # dispersion and orbit change with a constant slope
+            return entry(column) + entry(kind+'P'+plane)*d
+        elif kind in ('DP', 'P'):
+            return entry(column)
+    except KeyError:
+        pass
+    return None
+
+def _RowsByValue(values):
+    codes   = {}
+    inverse = _np.fromiter((codes.setdefault(value, len(codes)) for value in values),
+                           dtype=int, count=len(values))
+    rows    = _np.argsort(inverse, kind='mergesort') # stable so rows stay in order
+    rows.flags.writeable = False
+    counts  = _np.bincount(inverse, minlength=len(codes))
+    ends    = _np.cumsum(counts)
+    starts  = ends - counts
+    return dict((value, rows[starts[code]:ends[code]]) for value,code in codes.items())
+
+# tfs2gmad removes punctuation other than underscores from names
+_gmadPunctuation = _re.compile('[' + _re.escape(_string.punctuation.replace('_', '')) + ']')
+
+def _GmadNameIndex(names):
+    """
+    Return (stripped, order, ordered): names with the punctuation removed
+    as for gmad, the rows that sort them and the sorted stripped names.
+    """
+    if len(names) == 0:
+        stripped = _np.zeros(0, dtype=str)
+    else:
+        # one substitution for all names rather than one per name
+        stripped = _np.array(_gmadPunctuation.sub('', '\n'.join(names)).split('\n'))
+    order = _np.argsort(stripped, kind='mergesort')
+    return stripped, order, stripped[order]
+
+class _LazyColumns(dict):
+    """
+    Dictionary of column name to array in which some columns are only
+    made on first use.  Defer registers a function for a group of columns
+    that is called the first time any of them is looked up.  Deferred
+    columns count as present for 'in'.
+
+    Arrays may be shared between instances (see Share), so any change to
+    the values in an array must be made through Writable.
+    """
+    def __init__(self, *args):
+        dict.__init__(self, *args)
+        self._deferred = {}
+        self._taken    = {} # column -> (values, indices) for deferred takes
+        self._derived  = {} # column -> {name : value}, see Derived
+        self._pending  = {} # column -> list the array goes in when made, see Take
+
+    def Defer(self, columns, function):
+        """
+        function is called with no arguments and must return a list of
+        one array per name in columns.
+        """
+        group = (list(columns), function)
+        for column in columns:
+            self._MakePending(column)
+            dict.pop(self, column, None)
+            self._taken.pop(column, None)
+            self._derived.pop(column, None)
+            self._deferred[column] = group
+
+    def DeferTake(self, column, values, indices):
+        """
+        Defer column as values[indices], where values is a read-only
+        array and indices an integer array (see Take).
+        """
+        self.Defer([column], lambda: [values[indices]])
+        self._taken[column] = (values, indices)
+
+    def __missing__(self, column):
+        group = self._deferred[column]
+        for name,values in zip(group[0], group[1]()):
+            if self._deferred.get(name) is group:
+                del self._deferred[name]
+                self._taken.pop(name, None)
+                if name in self._pending:
+                    # already given to other instances by Take
+                    values.flags.writeable = False
+                    self._pending.pop(name).append(values)
+                dict.__setitem__(self, name, values)
+        return dict.__getitem__(self, column)
+
+    def _MakePending(self, column):
+        # make a deferred column that other instances wait on before it's
+        # replaced, so they get the values it had when they were made
+        if column in self._pending:
+            self[column]
+
+    def __setitem__(self, column, values):
+        self._MakePending(column)
+        self._deferred.pop(column, None)
+        self._taken.pop(column, None)
+        self._derived.pop(column, None)
+        dict.__setitem__(self, column, values)
+
+    def __contains__(self, column):
+        return dict.__contains__(self, column) or column in self._deferred
+
+    def __reduce__(self):
+        # make any deferred columns so copies and pickles hold only arrays
+        for column in list(self._deferred):
+            self[column]
+        return (_LazyColumns, (dict(self),))
+
+    def Share(self, column):
+        """
+        Return the array for column marked read-only so that views of it
+        can be given to another instance.
+        """
+        values = self[column]
+        values.flags.writeable = False
+        return values
+
+    def Take(self, column, rows, other):
+        """
+        Put the values of column in the rows selected by rows (a slice or
+        an integer array) in other, another _LazyColumns, without copying.
+        For a slice of a made column other gets a view of it, otherwise
+        other's column is deferred and gathered on first use.  Nothing is
+        made here: a column that is itself a deferred take has the indices
+        combined, so selections of selections cost only the final one, and
+        a column that is still deferred is only made (read-only) when other
+        first uses it.
+        """
+        if column in self._taken:
+            values, indices = self._taken[column]
+            other.DeferTake(column, values, indices[rows])
+        elif dict.__contains__(self, column):
+            values = self.Share(column)
+            if isinstance(rows, slice):
+                other[column] = values[rows]
+            else:
+                other.DeferTake(column, values, rows)
+        else:
+            made = self._pending.setdefault(column, [])
+            def Fetch():
+                if not made:
+                    self[column] # puts the read-only array in made
+                return [made[0][rows]]
+            other.Defer([column], Fetch)
+
+    def Writable(self, column):
+        """
+        Return the array for column to be changed in place.  It is copied
+        first if it is read-only, i.e. may be shared with another instance,
+        so changes are never seen by the other (copy on write).
+        """
+        values = self[column]
+        if not values.flags.writeable:
+            values = values.copy()
+            self[column] = values
+        self._derived.pop(column, None) # the values may change
+        return values
+
+    def Derived(self, column, name, function):
+        """
+        Return function(array for column), which is made on first use and
+        kept under name until the column is changed.
+        """
+        values  = self[column] # first as making a deferred column resets it
+        derived = self._derived.setdefault(column, {})
+        if name not in derived:
+            derived[name] = function(values)
+        return derived[name]
+
+    def RowsByValue(self, column):
+        """
+        Return a dictionary of each distinct value in column to the
+        (read-only) array of rows with that value in increasing order.
+        It's made on first use and kept until the column is changed.
+        """
+        return self.Derived(column, 'rowsbyvalue', _RowsByValue)
+
+class _TfsRow(object):
+    """
+    List-like access to one row of a Tfs instance in column order.
+    Reading and writing go directly to the column arrays.
+    """
+    __slots__ = ('_tfs', '_index')
+    def __init__(self, tfs, index):
+        self._tfs   = tfs
+        self._index = index
+
+    def __len__(self):
+        return len(self._tfs.columns)
+
+    def __getitem__(self, i):
+        columns = self._tfs.columns[i]
+        if type(i) == slice:
+            return [self._tfs._columndata[c][self._index] for c in columns]
+        return self._tfs._columndata[columns][self._index]
+
+    def __setitem__(self, i, value):
+        self._tfs._columndata.Writable(self._tfs.columns[i])[self._index] = value
+
+    def __iter__(self):
+        for column in self._tfs.columns:
+            yield self._tfs._columndata[column][self._index]
+
+    def __repr__(self):
+        return repr(list(self))
+
+class _TfsRecord(_Mapping):
+    """
+    Read-only dictionary-like view of one row of a Tfs instance keyed by
+    column name.  Values are read from the column arrays when looked up,
+    so no dictionary is made for each row.
+    """
+    __slots__ = ('_tfs', '_index')
+    def __init__(self, tfs, index):
+        self._tfs   = tfs
+        self._index = index
+
+    def __getitem__(self, column):
+        return self._tfs._columndata[column][self._index]
+
+    def __iter__(self):
+        return iter(self._tfs.columns)
+
+    def __len__(self):
+        return len(self._tfs.columns)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+class _TfsRows(object):
+    """
+    Dictionary-like view of the rows of a Tfs instance keyed by the
+    (mangled) element name.
+    """
+    __slots__ = ('_tfs',)
+    def __init__(self, tfs):
+        self._tfs = tfs
+
+    def __len__(self):
+        return len(self._tfs.sequence)
+
+    def __contains__(self, name):
+        return name in self._tfs._RowIndex()
+
+    def __getitem__(self, name):
+        return _TfsRow(self._tfs, self._tfs._RowIndex()[name])
+
+    def __iter__(self):
+        return iter(self._tfs.sequence)
+
+    def keys(self):
+        return list(self._tfs.sequence)
+
+    def values(self):
+        return [self[name] for name in self._tfs.sequence]
+
+    def items(self):
+        return [(name, self[name]) for name in self._tfs.sequence]
+
+    def iteritems(self):
+        for name in self._tfs.sequence:
+            yield name, self[name]
+
+    def has_key(self, name):
+        return name in self
 
 def CheckItsTfs(tfsfile):
     """
@@ -1079,7 +2368,7 @@ def CheckItsTfs(tfsfile):
 
     tfsfile can be either a tfs instance or a string.
     """
-    if type(tfsfile) == str:
+    if _Filename(tfsfile) is not None:
         madx = Tfs(tfsfile)
     elif type(tfsfile) == Tfs:
         madx = tfsfile
@@ -1087,6 +2376,408 @@ def CheckItsTfs(tfsfile):
         raise IOError("Not pymadx.Data.Tfs file type: "+str(tfsfile))
     return madx
 
+class TfsReader(object):
+    """
+    Read a tfs file piece by piece so that files too large to fit in memory,
+    such as PTC track tables, can be processed with bounded memory.
+
+    >>> r = TfsReader("track.tfs")
+    >>> for chunk in r.IterChunks(100000):
+    ...     xsum += chunk.GetColumn('X').sum()
+    >>> for segment in r.IterSegments():
+    ...     print(segment.segments, segment.GetColumn('X').std())
+
+    The header, column names and formats are read once on construction and
+    are available as the members header, columns and formats.  Each chunk
+    or segment is a Tfs instance with all the same capabilities, but note
+    element names are only made unique within each one.
+
+    filename may also be an open file or other iterable of lines, in which
+    case the data can only be iterated over once.
+
+    If columns is a list of column names, only these columns (and NAME)
+    are loaded in each piece.
+    member is the name of the file to read in a tar archive, by default
+    the first.
+    """
+    def __init__(self, filename, verbose=False, columns=None, member=None):
+        self.filename = _Filename(filename) or filename
+        self._verbose = verbose
+        self._columns = columns
+        self._member  = member
+        self._file    = None
+        if _Filename(filename) is not None:
+            self._file = _OpenTfsFile(self.filename, member)
+            lines = self._file
+        else:
+            lines = filename
+        self._parser = _TfsParser(lines, verbose)
+        self.header  = self._parser.header
+        self.columns = self._parser.columns
+        self.formats = self._parser.formats
+        self._unread = True # whether the data in self._parser is still to be read
+
+    def __repr__(self):
+        return "<pymadx.Data.TfsReader, {} columns ({})>".format(len(self.columns),
+                                                                 self.filename)
+
+    def IterChunks(self, nrows):
+        """
+        Yield the data as Tfs instances of (at most) nrows rows each.
+        """
+        return self._Iter(nrows, False)
+
+    def IterSegments(self):
+        """
+        Yield the data as one Tfs instance per segment, as found in PTC
+        track tables with one segment per observation point.
+        """
+        return self._Iter(None, True)
+
+    def _Iter(self, nrows, bysegment):
+        if self._unread:
+            parser = self._parser
+            self._unread = False
+        elif _Filename(self.filename) is not None:
+            # open the file again but reuse the header already read
+            self._file = _OpenTfsFile(self.filename, self._member)
+            parser = _TfsParser(self._file, template=self._parser)
+        else:
+            raise ValueError("The data from this iterable has already been read")
+
+        try:
+            sstart = 0
+            for block in parser.IterBlocks(nrows, bysegment):
+                chunk = Tfs()
+                chunk._LoadBlocks(parser, [block], sstart, self._columns)
+                chunk.filename = _Filename(self.filename)
+                if 'S' in chunk.columns and len(chunk) > 0:
+                    sstart = chunk.smax # so SMID is continuous between chunks
+                yield chunk
+        finally:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+def LoadMany(filenames, nworkers=None, chunksize=1, **kwargs):
+    """
+    Load many tfs files in parallel and return a list of Tfs instances in
+    the same order as filenames.
+
+    >>> twisses = LoadMany("errors/seed_*.tfs", nworkers=8)
+
+    filenames  - list of file names or a glob pattern (sorted)
+    nworkers   - number of worker processes (default the number of cpus);
+                 1 loads the files one by one in this process
+    chunksize  - number of files given to a worker at once; larger values
+                 reduce the overhead for many small files
+    kwargs     - passed to Tfs, e.g. columns or cache
+
+    Each worker sends back the column arrays as they are, without the
+    per-row overhead of sending Tfs instances.
+    """
+    if _Filename(filenames) is not None:
+        filenames = sorted(_glob.glob(_Filename(filenames)))
+    filenames = list(filenames)
+    tasks = [(filename, kwargs) for filename in filenames]
+    if nworkers == 1 or len(filenames) < 2:
+        states = [_LoadState(task) for task in tasks]
+    else:
+        pool = _multiprocessing.Pool(nworkers)
+        try:
+            states = pool.map(_LoadState, tasks, chunksize)
+        finally:
+            pool.close()
+            pool.join()
+
+    result = []
+    for filename,state in zip(filenames, states):
+        t = Tfs()
+        t._SetCacheState(*state)
+        t.filename = filename
+        result.append(t)
+    return result
+
+def _LoadState(task):
+    # run in a worker process for LoadMany
+    filename, kwargs = task
+    return Tfs(filename, **kwargs)._GetCacheState()
+
+def Concatenate(instances, offsetS=True):
+    """
+    Return a new Tfs instance with the rows of each of instances in turn,
+    e.g. to join the twiss of consecutive sections of a transfer line.
+
+    >>> line = Concatenate([section1, section2, section3])
+
+    offsetS  - if True the S, SMID and SORIGINAL of each instance are
+               shifted so its first element starts where the previous
+               instance ends (so the result can be sliced), otherwise
+               they are kept as they are.
+
+    The columns are those of the first instance, which all others must
+    have.  A name that is already in an earlier instance has '_' and the
+    first free number appended, e.g. joining two copies of a file with D,
+    D_1 and D_2 gives D_3, D_1_1 and D_2_1 in the second.  The header
+    is that of the first instance with any keys only in the others added
+    (the first value found is kept) and LENGTH, if present, set to the
+    total length when S is offset.
+    """
+    instances = list(instances)
+    if len(instances) == 0:
+        return Tfs()
+    first = instances[0]
+    for instance in instances[1:]:
+        missing = [c for c in first.columns if c not in instance.columns]
+        if missing:
+            raise ValueError("Columns "+str(missing)+" missing from "+str(instance.filename))
+
+    result = Tfs()
+    result._CopyMetaData(first)
+    for instance in instances:
+        for key,value in instance.header.items():
+            result.header.setdefault(key, value)
+        result.segments.extend(instance.segments)
+    result.nsegments = len(result.segments)
+
+    # each column is made in one go rather than by appending
+    for column in first.columns:
+        result._columndata[column] = _np.concatenate([i._columndata[column] for i in instances])
+    result._ExtendSequence(first.sequence, mangle=False)
+    for instance in instances[1:]:
+        result._ExtendSequence(instance.sequence, mangle=True)
+    if 'UNIQUENAME' in result.columns:
+        result._columndata['UNIQUENAME'] = _ColumnArray(result.sequence, '%s')
+
+    if 'S' in result.columns and result.nitems > 0:
+        if offsetS:
+            # each instance starts at the start of its first element
+            offsets, originals = [], []
+            begin, end = None, None
+            for instance in instances:
+                if len(instance) == 0:
+                    offsets.append(0.0)
+                    originals.append(0.0)
+                    continue
+                s = instance._columndata['S']
+                start = s[0] - instance._columndata['L'][0] if 'L' in instance.columns else s[0]
+                if begin is None:
+                    begin, end = start, start
+                offsets.append(end - start)
+                end = s[-1] + offsets[-1]
+                # SORIGINAL of a slice isn't rebased like its S
+                if 'SORIGINAL' in instance.columns:
+                    originals.append(offsets[-1] + s[0] - instance._columndata['SORIGINAL'][0])
+                else:
+                    originals.append(offsets[-1])
+            lengths = [len(i) for i in instances]
+            shifts  = {'S'         : _np.repeat(offsets, lengths),
+                       'SMID'      : _np.repeat(offsets, lengths),
+                       'SORIGINAL' : _np.repeat(originals, lengths)}
+            for column,shift in shifts.items():
+                if column in result.columns:
+                    result._columndata[column] = result._columndata[column] + shift
+            if 'LENGTH' in result.header:
+                result.header['LENGTH'] = end - begin
+        s = result._columndata['S']
+        result.smin = s[0]
+        result.smax = s[-1]
+    return result
+
+_compareColumns = ['BETX', 'BETY', 'ALFX', 'ALFY', 'MUX', 'MUY', 'DX', 'DY',
+                   'DPX', 'DPY', 'X', 'Y', 'PX', 'PY']
+
+def Compare(tfsa, tfsb, columns=None, on='UNIQUENAME', tolerance=None):
+    """
+    Compare the columns of tfsb to those of tfsa, e.g. a perturbed twiss
+    to the nominal one, row by row and return a TfsComparison.
+
+    >>> c = Compare(nominal, perturbed, ['BETX', 'BETY', 'DX'])
+    >>> c.beat['BETX'] # beta beat
+    >>> c.Statistics('beat')
+
+    columns    - columns to compare (default the optical functions and
+                 orbit that are in both)
+    on         - how rows are matched:
+                 'UNIQUENAME' names in the sequence, e.g. D_2 is the 3rd D
+                 'NAME'       names in the file, the nth of a name in one
+                              with the nth in the other
+                 'S'          the nearest S in tfsb for each row of tfsa
+    tolerance  - largest difference in S for rows to match with on='S'
+
+    Rows of tfsa that don't match a row of tfsb are left out.  tfsb may
+    also be a list of Tfs instances (e.g. error seeds), in which case a
+    list of comparisons is returned and tfsa is only indexed once.
+    """
+    if isinstance(tfsb, Tfs):
+        return Compare(tfsa, [tfsb], columns, on, tolerance)[0]
+    if on not in ('UNIQUENAME', 'NAME', 'S'):
+        raise ValueError("Unknown key to match rows on: "+str(on))
+
+    result = []
+    for other in tfsb:
+        names = columns
+        if names is None:
+            names = [c for c in _compareColumns if c in tfsa.columns and c in other.columns]
+        for name in names:
+            for t in (tfsa, other):
+                t.ColumnIndex(name) # raises ValueError if not present
+                if t._columndata[name].dtype.kind not in 'fiu':
+                    raise ValueError("Column "+name+" isn't numerical")
+        rowsa, rowsb = _MatchRows(tfsa, other, on, tolerance)
+        result.append(TfsComparison(tfsa, other, names, rowsa, rowsb))
+    return result
+
+def _NameOccurrences(names):
+    """
+    Return a list of (name, n) for each of names, where n counts the
+    previous occurrences of that name.
+    """
+    counts = {}
+    keys   = []
+    for name in names:
+        n = counts.get(name, 0)
+        counts[name] = n + 1
+        keys.append((name, n))
+    return keys
+
+def _MatchRows(tfsa, tfsb, on, tolerance=None):
+    """
+    Return arrays (rowsa, rowsb) of the rows of tfsa and the rows of tfsb
+    they match (see Compare), in order of rowsa, or slices of all rows if
+    the rows are the same.
+    """
+    if on == 'S':
+        sa, sb = tfsa._columndata['S'], tfsb._columndata['S']
+        if len(sb) == 0:
+            return _np.zeros(0, dtype=int), _np.zeros(0, dtype=int)
+        after  = _np.clip(_np.searchsorted(sb, sa), 1, max(len(sb)-1, 1))
+        before = after - 1
+        after  = _np.minimum(after, len(sb)-1)
+        rowsb  = _np.where(_np.abs(sb[after] - sa) < _np.abs(sa - sb[before]), after, before)
+        rowsa  = _np.arange(len(sa))
+        if tolerance is not None:
+            close = _np.abs(sb[rowsb] - sa) <= tolerance
+            rowsa, rowsb = rowsa[close], rowsb[close]
+        return rowsa, rowsb
+
+    # hash join on the names, indexing tfsa once however many it's compared to
+    if on == 'UNIQUENAME':
+        keysa, keysb = tfsa.sequence, tfsb.sequence
+    else:
+        keysa = tfsa._columndata.Derived('NAME', 'occurrences', _NameOccurrences)
+        keysb = tfsb._columndata.Derived('NAME', 'occurrences', _NameOccurrences)
+    if keysa == keysb:
+        # the same lattice, as usual for error seeds
+        return slice(None), slice(None)
+    if on == 'UNIQUENAME':
+        index = tfsa._RowIndex()
+    else:
+        index = tfsa._columndata.Derived('NAME', 'occurrenceindex',
+                                         lambda names: dict((k,i) for i,k in enumerate(keysa)))
+    rowsa = _np.fromiter((index.get(key, -1) for key in keysb), dtype=int, count=len(keysb))
+    rowsb = _np.flatnonzero(rowsa >= 0)
+    rowsa = rowsa[rowsb]
+    order = _np.argsort(rowsa, kind='mergesort')
+    return rowsa[order], rowsb[order]
+
+class TfsComparison(object):
+    """
+    Row by row comparison of the columns of two Tfs instances, a and b,
+    made by Compare.
+
+    | `c` has data members:
+    | columns     - list of compared column names
+    | names       - names (in a's sequence) of the matched rows
+    | s           - S in a of the matched rows
+    | rowsa       - index in a of each matched row
+    | rowsb       - index in b of each matched row
+    | a, b        - dictionary of column to the values in a and b
+    | diff        - dictionary of column to b - a
+    | ratio       - dictionary of column to b / a
+    | beat        - dictionary of column to (b - a) / a, e.g. the beta beat
+
+    The ratio and beat are NaN where a is 0.
+    """
+    def __init__(self, tfsa, tfsb, columns, rowsa, rowsb):
+        self.filenames = (tfsa.filename, tfsb.filename)
+        self.columns   = list(columns)
+        # rows are slices (all rows) for the same lattices, so the values
+        # are copied to not be views of the instances' columns
+        self.rowsa     = _np.arange(len(tfsa))[rowsa]
+        self.rowsb     = _np.arange(len(tfsb))[rowsb]
+        self._sequence = list(tfsa.sequence)
+        self._names    = None
+        self.s         = _np.array(tfsa._columndata['S'][rowsa], dtype=float) if 'S' in tfsa.columns else None
+        self.a, self.b = {}, {}
+        self.diff, self.ratio, self.beat = {}, {}, {}
+        for column in self.columns:
+            a = _np.array(tfsa._columndata[column][rowsa], dtype=float)
+            b = _np.array(tfsb._columndata[column][rowsb], dtype=float)
+            self.a[column]    = a
+            self.b[column]    = b
+            self.diff[column] = b - a
+            with _np.errstate(divide='ignore', invalid='ignore'):
+                beat = self.diff[column] / a
+            beat[a == 0] = _np.nan
+            self.beat[column]  = beat
+            self.ratio[column] = beat + 1.0
+
+    @property
+    def names(self):
+        if self._names is None:
+            self._names = [self._sequence[i] for i in self.rowsa]
+        return self._names
+
+    def __repr__(self):
+        return '<pymadx.Data.TfsComparison, ' + str(len(self)) + ' rows of ' + str(self.filenames) + '>'
+
+    def __len__(self):
+        return len(self.rowsa)
+
+    def Statistics(self, quantity='diff'):
+        """
+        Return a dictionary of column to a dictionary of statistics of one
+        of the compared quantities ('diff', 'ratio' or 'beat') over all
+        matched rows: mean, std, rms, min, max, maxabs and maxabsname, the
+        row where the absolute value is largest.  NaNs are ignored.
+        """
+        values = getattr(self, quantity)
+        result = {}
+        for column in self.columns:
+            v = values[column]
+            finite = _np.isfinite(v)
+            if not finite.any():
+                result[column] = None
+                continue
+            v = v[finite]
+            i = _np.argmax(_np.abs(v))
+            result[column] = {'mean'       : _np.mean(v),
+                              'std'        : _np.std(v),
+                              'rms'        : _np.sqrt(_np.mean(v**2)),
+                              'min'        : _np.min(v),
+                              'max'        : _np.max(v),
+                              'maxabs'     : _np.abs(v[i]),
+                              'maxabsname' : self._sequence[self.rowsa[finite][i]]}
+        return result
+
+    def Report(self, quantity='diff'):
+        """
+        Print the statistics of one of the compared quantities ('diff',
+        'ratio' or 'beat') for each column.
+        """
+        print('Comparison of',self.filenames[1],'to',self.filenames[0])
+        print('Matched rows >',len(self))
+        print('Column'.ljust(10,'.'),'Mean'.rjust(13),'RMS'.rjust(13),('Max |'+quantity+'|').rjust(13),'At')
+        statistics = self.Statistics(quantity)
+        for column in self.columns:
+            stats = statistics[column]
+            if stats is None:
+                print(column.ljust(10,'.'),'no values')
+                continue
+            print(column.ljust(10,'.'),('%13.6g' % stats['mean']),('%13.6g' % stats['rms']),
+                  ('%13.6g' % stats['maxabs']),stats['maxabsname'])
+
 _madxAperTypes = { 'CIRCLE',
                    'RECTANGLE',
                    'ELLIPSE',
@@ -1125,19 +2816,29 @@ class Aperture(Tfs):
         # create a cache of which aperture is at which s position
         # do this by creatig a map of the s position of each entry
         # with the associated
-        self.cache = {}
-        for item in self:
-            s = item['S']
-            if s in self.cache.keys():
-                #if existing one is zero and other isn't replace it
-                if ZeroAperture(self.cache[s]) and NonZeroAperture(item):
-                    self.cache[s] = item
-            else:
-                self.cache[s] = item
-
-        # dictionary is not ordered to keep list of ordered s positions
-        self._ssorted = self.cache.keys()
-        self._ssorted.sort()
+        # the first entry at each s is used unless it's zero and a
+        # later one isn't
+        self.cache    = {}
+        self._ssorted = []
+        if 'S' in self.columns and len(self) > 0:
+            s      = self.GetColumn('S')
+            order  = _np.argsort(s, kind='mergesort') # keeps the order of equal s
+            starts = _np.flatnonzero(_np.concatenate(([True], _np.diff(s[order]) != 0)))
+            keys   = [k for k in ['APER_1', 'APER_2', 'APER_3', 'APER_4'] if k in self.columns]
+            chosen = order[starts]
+            if keys:
+                apers   = _np.array([self.GetColumn(k) for k in keys])
+                zero    = (apers < 1e-9).all(axis=0)[order]  # as ZeroAperture
+                nonzero = (apers > 1e-9).any(axis=0)[order]  # as NonZeroAperture
+                positions = _np.where(nonzero, _np.arange(len(order)), len(order))
+                firstnonzero = _np.minimum.reduceat(positions, starts)
+                replace = zero[starts] & (firstnonzero < len(order))
+                chosen  = order[_np.where(replace, firstnonzero, starts)]
+            self._ssorted = list(s[chosen])
+            # a dictionary of each row as GetRowDict, made a column at a time
+            values = [self._columndata[c][chosen] for c in self.columns]
+            rows   = [dict(zip(self.columns, row)) for row in zip(*values)]
+            self.cache = dict(zip(self._ssorted, rows))
 
         # pull out some aperture values for conevience
         # try this as class may be constructed with no data
@@ -1169,6 +2870,8 @@ class Aperture(Tfs):
 
     def CheckKnownApertureTypes(self):
         failed = False
+        if 'APERTYPE' not in self.columns:
+            return # not loaded
         ts = set(self.GetColumn('APERTYPE'))
         for t in ts:
             if t not in _madxAperTypes:
@@ -1207,13 +2910,7 @@ class Aperture(Tfs):
 
         a = Aperture(debug=self.debug, quiet=True)
         a._CopyMetaData(self)
-        for item in self:
-            if item[atKey] == "":
-                pass #don't copy
-            else:
-                #copy over as normal
-                key = self.sequence[self._iterindex]
-                a._AppendDataEntry(key, self.data[key])
+        a._ViewRows(self, _np.flatnonzero(self._columndata[atKey] != ""))
         a._UpdateCache()
         return a
 
@@ -1241,16 +2938,17 @@ class Aperture(Tfs):
             else:
                 print(key,' will be ignored as not in this aperture Tfs file')
 
+        # one row per element and one column per aperture key
+        apervals = _np.zeros((len(self), len(aperkeys)))
+        for i,key in enumerate(aperkeys):
+            apervals[:,i] = self._columndata[key]
+        belowlimit = apervals < limitvals
+        belowlimittotal = belowlimit.any(axis=1) # if any are true
+
         # 'quiet' stops it complaining about not finding metadata
         a = Aperture(debug=self.debug, quiet=True)
         a._CopyMetaData(self)
-        for item in self:
-            apervals = _np.array([item[key] for key in aperkeys])
-            abovelimit = apervals < limitvals
-            abovelimittotal = abovelimit.any() # if any are true
-            if not abovelimittotal:
-                key = self.sequence[self._iterindex]
-                a._AppendDataEntry(key, self.data[key])
+        a._ViewRows(self, _np.flatnonzero(~belowlimittotal))
         a._UpdateCache()
         return a
 
@@ -1278,16 +2976,17 @@ class Aperture(Tfs):
             print('No aperture values to check')
             return self
 
+        # one row per element and one column per aperture key
+        apervals = _np.zeros((len(self), len(aperkeys)))
+        for i,key in enumerate(aperkeys):
+            apervals[:,i] = self._columndata[key]
+        abovelimit = apervals > limitvals
+        abovelimittotal = abovelimit.any(axis=1) # if any are true
+
         # 'quiet' stops it complaining about not finding metadata
         a = Aperture(debug=self.debug, quiet=True)
         a._CopyMetaData(self)
-        for item in self:
-            apervals = _np.array([item[key] for key in aperkeys])
-            abovelimit = apervals > limitvals
-            abovelimittotal = abovelimit.any() # if any are true
-            if not abovelimittotal:
-                key = self.sequence[self._iterindex]
-                a._AppendDataEntry(key, self.data[key])
+        a._ViewRows(self, _np.flatnonzero(~abovelimittotal))
         a._UpdateCache()
         return a
 
@@ -1308,9 +3007,7 @@ class Aperture(Tfs):
         a = Aperture(debug=self.debug, quiet=True)
         a._CopyMetaData(self)
         u,indices = _np.unique(self.GetColumn('S'), return_index=True)
-        for ind in indices:
-            key = self.sequence[ind]
-            a._AppendDataEntry(key, self.data[key])
+        a._ViewRows(self, indices)
         a._UpdateCache()
         return a
 
@@ -1384,17 +3081,11 @@ class Aperture(Tfs):
         print('Aperture> replacing',existingType,'with',replacementType)
         et = existingType    #shortcut
         rt = replacementType #shortcut
-        try:
-            index = self.columns.index('APERTYPE')
-        except ValueError:
+        if 'APERTYPE' not in self.columns:
             print('No apertype column, therefore no type to replace')
             return
-        for item in self:
-            try:
-                if item['APERTYPE'] == et:
-                    self.data[item['NAME']][index] = rt
-            except KeyError:
-                return
+        apertype = self._columndata.Writable('APERTYPE')
+        apertype[apertype == et] = rt
 
     def ShouldSplit(self, rowDictionary):
         """
@@ -1505,7 +3196,7 @@ def CheckItsTfsAperture(tfsfile):
 
     tfsfile can be either a tfs instance or a string.
     """
-    if type(tfsfile) == str:
+    if _Filename(tfsfile) is not None:
         aper = Aperture(tfsfile)
     elif type(tfsfile) == Aperture:
         aper = tfsfile
@@ -0,0 +1,129 @@
+# pymadx._Cache - binary cache of parsed tfs files
+
+"""
+Binary cache of parsed tfs files so they don't have to be parsed as text
+again each time they're loaded.
+
+Each cached file is a directory named by a hash of the source file path,
+size and modification time.  Numeric columns are stored as one .npy file
+each so they can be memory-mapped when loaded.  Everything else (header,
+string columns, sequence etc.) is pickled in meta.pickle.  The least
+recently used entries are removed when the cache grows beyond its maximum
+size.
+"""
+
+import hashlib as _hashlib
+import numpy as _np
+import os as _os
+import pickle as _pickle
+import shutil as _shutil
+
+# increment if the layout of the cached data changes
+_cacheVersion = 1
+
+_cacheDirectory = _os.path.join(_os.path.expanduser('~'), '.cache', 'pymadx')
+_cacheMaxSize   = 2*1024**3 # bytes
+
+def SetCacheDirectory(directory):
+    """
+    Set the directory the binary cache of tfs files is kept in.
+    """
+    global _cacheDirectory
+    _cacheDirectory = directory
+
+def SetCacheMaxSize(nbytes):
+    """
+    Set the maximum total size in bytes of the binary cache of tfs files.
+    The least recently used files are removed beyond this.
+    """
+    global _cacheMaxSize
+    _cacheMaxSize = nbytes
+
+def ClearCache():
+    """
+    Remove all files from the binary cache of tfs files.
+    """
+    for entry in _Entries():
+        _shutil.rmtree(entry, ignore_errors=True)
+
+def _EntryPath(filename, extra=''):
+    """
+    Return the cache directory for filename, which depends on its
+    absolute path, size and modification time and the string extra.
+    """
+    path = _os.path.abspath(filename)
+    st   = _os.stat(path)
+    key  = "{}|{}|{}|{}|{}".format(_cacheVersion, path, st.st_size, st.st_mtime, extra)
+    return _os.path.join(_cacheDirectory, _hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+def _Entries():
+    if not _os.path.isdir(_cacheDirectory):
+        return []
+    entries = [_os.path.join(_cacheDirectory, e) for e in _os.listdir(_cacheDirectory)]
+    return [e for e in entries if _os.path.isfile(_os.path.join(e, 'meta.pickle'))]
+
+def _Size(entry):
+    return sum(_os.path.getsize(_os.path.join(entry, f)) for f in _os.listdir(entry))
+
+def Load(filename, extra=''):
+    """
+    Return (meta, arrays) for filename from the cache or None if it isn't
+    cached.  arrays is a dictionary of column name to memory-mapped
+    array - these are copy on write so changes never reach the cache.
+    extra distinguishes different data cached for the same file, such as
+    a selection of its columns.
+    """
+    entry = _EntryPath(filename, extra)
+    metafile = _os.path.join(entry, 'meta.pickle')
+    if not _os.path.isfile(metafile):
+        return None
+    with open(metafile, 'rb') as f:
+        meta = _pickle.load(f)
+    arrays = {}
+    for i,column in enumerate(meta['arraycolumns']):
+        path = _os.path.join(entry, '{}.npy'.format(i))
+        try:
+            arrays[column] = _np.load(path, mmap_mode='c')
+        except ValueError:
+            arrays[column] = _np.load(path) # empty arrays can't be mapped
+    _os.utime(metafile, None) # mark as recently used
+    return meta, arrays
+
+def Save(filename, extra, meta, arrays):
+    """
+    Store meta (a picklable dictionary) and arrays (a dictionary of column
+    name to numeric array) in the cache for filename and extra (see Load),
+    then remove the least recently used entries if the cache is larger
+    than its maximum size.
+    """
+    entry = _EntryPath(filename, extra)
+    if _os.path.isdir(entry):
+        return
+    # write to a temporary directory and rename so a partial entry is never read
+    temp = "{}.{}.tmp".format(entry, _os.getpid())
+    try:
+        _os.makedirs(temp)
+    except OSError:
+        if not _os.path.isdir(temp):
+            raise
+    meta = dict(meta)
+    meta['arraycolumns'] = list(arrays.keys())
+    for i,column in enumerate(meta['arraycolumns']):
+        _np.save(_os.path.join(temp, '{}.npy'.format(i)), arrays[column])
+    with open(_os.path.join(temp, 'meta.pickle'), 'wb') as f:
+        _pickle.dump(meta, f, 2)
+    try:
+        _os.rename(temp, entry)
+    except OSError:
+        # another process cached the same file first
+        _shutil.rmtree(temp, ignore_errors=True)
+    _Evict()
+
+def _Evict():
+    entries = [(_os.path.getmtime(_os.path.join(e, 'meta.pickle')), _Size(e), e) for e in _Entries()]
+    total = sum(size for _,size,_ in entries)
+    for _,size,entry in sorted(entries):
+        if total <= _cacheMaxSize:
+            break
+        _shutil.rmtree(entry, ignore_errors=True)
+        total -= size
@@ -0,0 +1,577 @@
+import bz2
+import copy
+import gzip
+import pathlib
+import pickle
+import py
+import numpy as np
+import pytest
+import tarfile
+
+import pymadx
+
+_TWISS = """\
+@ NAME             %05s "TWISS"
+@ GAMMA            %le     2544.0
+@ EX               %le                 1e-09
+@ EY               %le                 1e-09
+@ SIGE             %le                 0.001
+* NAME      KEYWORD       S       L     BETX    ALFX    BETY    ALFY    DX     DPX    DY    DPY   K1L   HKICK   VKICK
+$ %s        %s            %le     %le   %le     %le     %le     %le     %le    %le    %le   %le   %le   %le     %le
+ "START"    "MARKER"      0.0     0.0   10.0    0.0     20.0    0.0     0.0    0.0    0.0   0.0   0.0   0.0     0.0
+ "D"        "DRIFT"       1.0     1.0   12.0    -1.0    18.0    1.0     0.1    0.0    0.0   0.0   0.0   0.0     0.0
+ "QF"       "QUADRUPOLE"  1.5     0.5   13.0    -0.5    17.0    0.5     0.1    0.0    0.0   0.0   0.2   0.0     0.0
+ "D"        "DRIFT"       2.5     1.0   11.0    1.0     19.0    -1.0    0.1    0.0    0.0   0.0   0.0   0.0     0.0
+ "HK"       "HKICKER"     3.0     0.5   10.0    1.0     20.0    -1.0    0.1    0.0    0.0   0.0   0.0   1e-4    0.0
+ "QD"       "QUADRUPOLE"  3.5     0.5   9.0     0.5     21.0    -0.5    0.1    0.0    0.0   0.0   -0.2  0.0     0.0
+ "D"        "DRIFT"       4.5     1.0   10.0    0.0     20.0    0.0     0.1    0.0    0.0   0.0   0.0   0.0     0.0
+ "END"      "MARKER"      4.5     0.0   10.0    0.0     20.0    0.0     0.1    0.0    0.0   0.0   0.0   0.0     0.0
+"""
+
+@pytest.fixture()
+def twissfile(tmpdir):
+    f = tmpdir.join("twiss.tfs")
+    f.write(_TWISS)
+    return str(f)
+
+@pytest.fixture()
+def twiss(twissfile):
+    return pymadx.Data.Tfs(twissfile)
+
+def test_Load(twiss):
+    assert len(twiss) == 8
+    assert twiss.sequence == ['START', 'D', 'QF', 'D_1', 'HK', 'QD', 'D_2', 'END']
+    assert twiss.header['EX'] == 1e-9
+    assert twiss.smax == 4.5
+    for column in ['SEGMENT', 'NAME', 'SORIGINAL', 'SMID', 'UNIQUENAME', 'SIGMAX', 'SIGMAYP']:
+        assert column in twiss.columns
+
+def test_pickle(twiss):
+    a = pickle.loads(pickle.dumps(twiss))
+    assert np.allclose(pickle.loads(pickle.dumps(twiss[2:5])).GetColumn('S'), [0.5, 1.5, 2.0])
+    assert a.sequence == twiss.sequence
+    for column in twiss.columns:
+        assert list(a.GetColumn(column)) == list(twiss.GetColumn(column))
+    b = copy.deepcopy(twiss.Select([1, 2]))
+    assert np.allclose(b.GetColumn('SIGMAX'), twiss.GetColumn('SIGMAX')[1:3])
+
+def test_sigma_independent_of_access_order(twissfile):
+    for lazy in [False, True]:
+        a = pymadx.Data.Tfs(twissfile, lazy=lazy)
+        b = pymadx.Data.Tfs(twissfile, lazy=lazy)
+        sigmax = a.GetColumn('SIGMAX')[2]
+        a.EditComponent(2, 'BETX', 1000.0)
+        b.EditComponent(2, 'BETX', 1000.0)
+        assert a.GetColumn('SIGMAX')[2] == b.GetColumn('SIGMAX')[2] == sigmax
+
+def test_GetColumn_is_read_only_view(twiss):
+    betx = twiss.GetColumn('BETX')
+    assert betx.dtype == np.float64
+    assert np.shares_memory(betx, twiss.GetColumn('BETX'))
+    with pytest.raises(ValueError):
+        betx[0] = 1.0
+    with pytest.raises(ValueError):
+        twiss.GetColumn('NOTACOLUMN')
+
+def test_GetRowDict(twiss):
+    row = twiss['QF']
+    assert row['K1L'] == 0.2
+    assert row['KEYWORD'] == 'QUADRUPOLE'
+    assert twiss[2] == row
+    assert twiss.GetRow('QF')[twiss.ColumnIndex('L')] == 0.5
+
+def test_iteration(twiss):
+    assert [row['NAME'] for row in twiss] == list(twiss.GetColumn('NAME'))
+    # loops can be nested
+    assert sum(1 for a in twiss for b in twiss) == len(twiss)**2
+    row = next(iter(twiss))
+    assert dict(row) == twiss.GetRowDict('START')
+    assert row == twiss[0]
+    assert row.get('NOTACOLUMN') is None
+
+def test_data_writes_through(twiss):
+    twiss.data['QF'][twiss.ColumnIndex('K1L')] = 0.3
+    assert twiss['QF']['K1L'] == 0.3
+    twiss.EditComponent(2, 'K1L', 0.4)
+    assert twiss.data['QF'][twiss.ColumnIndex('K1L')] == 0.4
+
+def test_slice(twiss):
+    a = twiss['QF':'QD']
+    assert a.sequence == ['QF', 'D_1', 'HK']
+    assert np.allclose(a.GetColumn('S'), [0.5, 1.5, 2.0])
+    assert np.allclose(twiss.GetColumn('S')[2:5], [1.5, 2.5, 3.0])
+
+def test_IndexFromNearestS(twiss):
+    assert twiss.IndexFromNearestS(1.2) == 2
+    assert twiss.IndexFromNearestS(1.5) == 3
+    assert twiss.NameFromNearestS(0.0) == 'D'
+    assert twiss.IndexFromNearestS(5.0) == -1
+    indices = twiss.IndexFromNearestS(np.array([0.5, 1.2, 2.9, 4.6]))
+    assert list(indices) == [1, 2, 4, -1]
+    assert twiss.NameFromNearestS([0.5, 3.2]) == ['D', 'QD']
+    with pytest.raises(ValueError):
+        twiss.IndexFromNearestS(-1.0)
+    with pytest.raises(ValueError):
+        twiss.IndexFromNearestS([1.0, 20.0])
+
+def test_InterpolateAt():
+    lines = ['@ EX %le 1e-9\n', '@ EY %le 1e-9\n', '@ SIGE %le 1e-3\n',
+             '* NAME  KEYWORD  S    BETX  ALFX  MUX  DX   DPX  BETY  ALFY  DY   DPY\n',
+             '$ %s    %s       %le  %le   %le   %le  %le  %le  %le   %le   %le  %le\n',
+             ' "START" "MARKER"     0.0  10.0  -1.0  0.0  0.5  0.1  10.0  0.0  0.0  0.0\n',
+             ' "D"     "DRIFT"      2.0  14.8  -1.4  0.1  0.7  0.1  10.4  -0.2 0.0  0.0\n',
+             ' "Q"     "QUADRUPOLE" 3.0  12.8  1.0   0.2  0.7  0.0  12.0  -1.0 0.0  0.0\n']
+    t = pymadx.Data.Tfs(lines)
+    optics = t.InterpolateAt([1.0, 2.5, 0.0, 3.0], ['BETX', 'ALFX', 'MUX', 'DX', 'KEYWORD', 'SIGMAX'])
+    # propagated through the drift and linear in the quadrupole
+    assert np.allclose(optics['BETX'], [12.2, 13.8, 10.0, 12.8])
+    assert np.allclose(optics['ALFX'], [-1.2, -0.2, -1.0, 1.0])
+    assert np.allclose(optics['MUX'][0], np.arctan2(1.0, 11.0) / (2*np.pi))
+    assert np.allclose(optics['DX'], [0.6, 0.7, 0.5, 0.7])
+    assert list(optics['KEYWORD']) == ['DRIFT', 'QUADRUPOLE', 'MARKER', 'QUADRUPOLE']
+    assert np.allclose(optics['SIGMAX'][0], np.sqrt(12.2e-9 + (0.6e-3)**2))
+    assert np.allclose(t.InterpolateAt(2.0, ['BETY'])['BETY'], 10.4)
+    with pytest.raises(ValueError):
+        t.InterpolateAt([1.0, 3.5])
+
+def test_IndexFromName_after_changes(twiss):
+    assert twiss.IndexFromName('QD') == 5
+    twiss.SplitElement(1.25)
+    assert twiss.IndexFromName('QD') == 6
+    twiss.RenameElement(6, 'QDNEW')
+    assert twiss.IndexFromName('QDNEW') == 6
+    with pytest.raises(ValueError):
+        twiss.IndexFromName('QD')
+    twiss.WrapAroundElement('QDNEW')
+    assert twiss.IndexFromName('QDNEW') == 0
+    assert twiss.IndexFromName('QF_split_2') == len(twiss) - 2
+    assert twiss['QF_split_2']['NAME'] == 'QF_split_2'
+
+def test_RenameElements(twiss):
+    twiss.RenameElements({'QF': 'QD', 'QD': 'QF', 7: 'FINISH'})
+    assert twiss.sequence == ['START', 'D', 'QD', 'D_1', 'HK', 'QF', 'D_2', 'FINISH']
+    assert twiss['QF']['K1L'] == -0.2 and twiss['FINISH']['NAME'] == 'FINISH'
+    twiss.RenameElements(lambda name: name.replace('_', '.'))
+    assert list(twiss.GetColumn('UNIQUENAME'))[3::3] == ['D.1', 'D.2']
+    assert twiss.IndexFromName('D.2') == 6
+    for renames in [{'D': 'HK'}, {'HK': 'X', 'QF': 'X'}, {'D.1': 'D'}, {'NOTANAME': 'X'}]:
+        with pytest.raises(ValueError):
+            twiss.RenameElements(renames)
+    assert twiss.sequence[:3] == ['START', 'D', 'QD']
+
+def test_SplitElements(twiss):
+    assert twiss.SplitElements([3.2, 0.3, 2.75, 3.4, 3.2]) == [(1, 2), (5, 6), (7, 8), (8, 9)]
+    assert twiss.sequence == ['START', 'D_split_1', 'D_split_2', 'QF', 'D_1', 'HK_split_1', 'HK_split_2',
+                              'QD_split_1', 'QD_split_2', 'QD_split_3', 'D_2', 'END']
+    assert np.allclose(twiss.GetColumn('L')[7:10], [0.2, 0.2, 0.1])
+    assert np.allclose(twiss.GetColumn('S')[7:10], [3.2, 3.4, 3.5])
+    assert np.allclose(twiss.GetColumn('SMID')[7:10], [3.1, 3.3, 3.45])
+    assert np.allclose(twiss.GetColumn('HKICK')[5:7], [0.5e-4, 0.5e-4])
+    assert twiss.GetColumn('UNIQUENAME')[9] == 'QD_split_3'
+    assert twiss.IndexFromName('D_2') == 10
+    with pytest.raises(ValueError):
+        twiss.SplitElements([5.0])
+    with pytest.raises(ValueError):
+        twiss.SplitElements([1.0, 4.5]) # at smax
+    twiss.EditComponent(3, 'L', 0.0)
+    with pytest.raises(ValueError):
+        twiss.SplitElements([1.2])
+    assert len(twiss) == 12
+
+def test_SplitElements_parts_sum_to_original(twissfile):
+    random = np.random.RandomState(1)
+    for _ in range(50):
+        twiss = pymadx.Data.Tfs(twissfile)
+        twiss.EditComponent(4, 'HKICK', 1.23456789e-4)
+        twiss.EditComponent(4, 'VKICK', -9.87654321e-6)
+        twiss.SplitElements(random.uniform(2.55, 2.95, random.randint(2, 6)))
+        parts = [i for i,name in enumerate(twiss.sequence) if name.startswith('HK_split')]
+        for column,original in [('L', 0.5), ('HKICK', 1.23456789e-4), ('VKICK', -9.87654321e-6)]:
+            assert sum(twiss.GetColumn(column)[parts]) == original
+
+def test_WrapAroundElement(twiss):
+    twiss.WrapAroundElement(4)
+    assert twiss.sequence == ['HK', 'QD', 'D_2', 'END', 'START', 'D', 'QF']
+    assert np.allclose(twiss.GetColumn('S'), [0.0, 0.5, 1.5, 1.5, 1.5, 2.5, 3.0])
+    assert np.allclose(twiss.GetColumn('SMID'), [0.0, 0.5, 1.25, 1.75, 1.75, 2.25, 3.0])
+    assert np.allclose(twiss.GetColumn('SIGMAX')[0], np.sqrt(10.0e-9 + (0.1e-3)**2))
+    assert twiss.IndexFromName('START') == 4
+
+def test_slice_shares_columns_until_changed(twiss):
+    a = twiss[2:6]
+    assert np.shares_memory(a.GetColumn('BETX'), twiss.GetColumn('BETX'))
+    assert np.allclose(a.GetColumn('S'), [0.5, 1.5, 2.0, 2.5])
+    a.EditComponent(0, 'BETX', 99.0)
+    assert twiss['QF']['BETX'] == 13.0
+    twiss.EditComponent(3, 'BETX', 98.0)
+    assert a['D_1']['BETX'] == 11.0
+    assert [len(twiss[3:]), len(twiss[:3]), len(twiss[::-1])] == [5, 3, 8]
+
+def test_copy_shares_columns_until_changed(twiss):
+    a = pymadx.Data.Tfs(twiss)
+    assert np.shares_memory(a.GetColumn('BETX'), twiss.GetColumn('BETX'))
+    a.EditComponent(2, 'BETX', 99.0)
+    a.RenameElement(0, 'BEGIN')
+    assert twiss['QF']['BETX'] == 13.0 and twiss.sequence[0] == 'START'
+    twiss.data['QD'][twiss.ColumnIndex('K1L')] = 0.0
+    assert a['QD']['K1L'] == -0.2
+    b = twiss[2:5]
+    assert len(b) == 3
+    b.EditComponent(0, 'BETX', 98.0)
+    assert twiss['QF']['BETX'] == 13.0
+
+def test_GetElementsOfType(twiss):
+    quads = twiss.GetElementsOfType('QUADRUPOLE')
+    assert quads.sequence == ['QF', 'QD']
+    assert np.allclose(quads.GetColumn('K1L'), [0.2, -0.2])
+    assert twiss.GetElementNamesOfType(['MARKER', 'HKICKER']) == ['START', 'HK', 'END']
+    # the index of rows by keyword is kept up to date
+    twiss.EditComponent(4, 'KEYWORD', 'QUADRUPOLE')
+    assert twiss.GetElementsOfType('QUADRUPOLE').sequence == ['QF', 'HK', 'QD']
+    twiss.WrapAroundElement('QD')
+    assert twiss.GetElementNamesOfType('QUADRUPOLE') == ['QD', 'QF']
+
+def test_IndexFromGmadName():
+    names = ['START', 'Q.F1', 'D$1', 'QF10', 'Q.F1', 'QD1', 'END']
+    lines = ['* NAME  S\n', '$ %s  %le\n'] + [' "{}" 1.0\n'.format(n) for n in names]
+    t = pymadx.Data.Tfs(lines)
+    assert t.IndexFromGmadName('QF1') == [1, 3, 4]
+    assert t.IndexFromGmadName('D1') == 2
+    with pytest.raises(ValueError):
+        t.IndexFromGmadName('QF2')
+    assert t.IndicesFromGmadNames(['QD1', 'QF10', 'X', 'Q[DF]1$']) == [[5], [3], [], [1, 4, 5]]
+    t.RenameElement(5, 'QF1X')
+    assert t.IndicesFromGmadNames(['QD1', 'QF1X']) == [[], [5]]
+    assert t.GetElementsWithTextInName(['Q.', '$']).sequence == ['Q.F1', 'D$1', 'Q.F1_1']
+
+def test_Select(twiss):
+    a = twiss.Select(twiss.GetColumn('S') > 1.2)
+    assert a.sequence == ['QF', 'D_1', 'HK', 'QD', 'D_2', 'END']
+    b = a.Select([1, 3])
+    assert b.sequence == ['D_1', 'QD']
+    assert 'BETX' not in dict(b._columndata) # gathered from twiss when first used
+    assert np.allclose(b.GetColumn('BETX'), [11.0, 9.0])
+    b.EditComponent(0, 'BETX', 99.0)
+    assert twiss['D_1']['BETX'] == 11.0 and a['D_1']['BETX'] == 11.0
+    with pytest.raises(ValueError):
+        twiss.Select([True, False])
+
+def test_Query(twiss):
+    q = twiss.Query("KEYWORD in ('QUADRUPOLE', 'HKICKER') and S > 2 and abs(K1L) > 0")
+    assert q.sequence == ['QD']
+    assert twiss.Query("not (BETX < 12) or HKICK != 0").sequence == ['D', 'QF', 'HK']
+    assert twiss.Query("KEYWORD not in ('DRIFT', 'MARKER')").sequence == ['QF', 'HK', 'QD']
+    assert len(twiss.Query("1 < S <= 3.0 and BETX*GAMMA > 25000")) == 3
+    assert twiss.Query("S in [1.0, 1.5]").sequence == ['D', 'QF']
+    for query in ["NOTACOLUMN > 1", "__import__('os')", "S.real > 0", "S >", "S in 5",
+                  "KEYWORD not in 'DRIFT'", "S in BETX"]:
+        with pytest.raises(ValueError):
+            twiss.Query(query)
+
+def test_Compare(twiss):
+    perturbed = pymadx.Data.Tfs(_TWISS.replace("13.0", "14.3").splitlines(True))
+    c = pymadx.Data.Compare(twiss, perturbed, ['BETX', 'DX'])
+    assert len(c) == 8 and c.names == twiss.sequence
+    assert np.allclose(c.beat['BETX'], [0, 0, 0.1, 0, 0, 0, 0, 0])
+    assert np.isnan(c.ratio['DX'][0]) # DX is 0
+    stats = c.Statistics('beat')
+    assert stats['BETX']['maxabsname'] == 'QF'
+    assert np.isclose(stats['BETX']['maxabs'], 0.1)
+    # the values are copies, not views of the instances' columns
+    c.a['BETX'][0] = 999.0
+    c.s[0] = 999.0
+    assert twiss['START']['BETX'] == 10.0 and twiss['START']['S'] == 0.0
+    twiss.EditComponent(2, 'BETX', 20.0)
+    assert c.a['BETX'][2] == 13.0 and np.isclose(c.beat['BETX'][2], 0.1)
+    twiss.EditComponent(2, 'BETX', 13.0)
+    # matched on names or S when the lattices differ
+    part = twiss.Select([0, 3, 5])
+    for on,rows in [('UNIQUENAME', [0, 3, 5]), ('S', [0, 3, 5]), ('NAME', [0, 1, 5])]:
+        c = pymadx.Data.Compare(part, twiss, on=on)
+        assert list(c.rowsb) == rows
+    assert np.allclose(c.diff['BETY'], [0, -1, 0]) # the 1st D of part is D_1
+    c = pymadx.Data.Compare(twiss, part, on='S', tolerance=0.1)
+    assert c.names == ['START', 'D_1', 'QD']
+    assert len(pymadx.Data.Compare(twiss, [twiss, perturbed])) == 2
+
+def test_Concatenate(twiss):
+    joined = pymadx.Data.Concatenate([twiss[:4], twiss[4:]])
+    assert joined.sequence == twiss.sequence
+    for column in ['S', 'SORIGINAL', 'BETX']:
+        assert np.allclose(joined.GetColumn(column), twiss.GetColumn(column))
+    assert joined.IndexFromNearestS(3.2) == 5
+    twice = pymadx.Data.Concatenate([twiss, twiss])
+    assert len(twice) == 16 and twice.smax == 9.0
+    assert twice.sequence[8:11] == ['START_1', 'D_3', 'QF_1']
+    assert list(twice.GetColumn('UNIQUENAME')) == twice.sequence
+    assert twice.IndexFromName('QF_1') == 10
+    assert np.allclose(twice.GetColumn('S')[8:], twiss.GetColumn('S') + 4.5)
+    assert twice.sequence[11:15] == ['D_1_1', 'HK_1', 'QD_1', 'D_2_1']
+    # slices across the join continue along the line
+    across = twice[5:12]
+    assert np.allclose(across.GetColumn('S'), [0.5, 1.5, 1.5, 1.5, 2.5, 3.0, 4.0])
+    assert across.smax == 4.0
+    across = pymadx.Data.Concatenate([twiss[2:6], twiss[2:6]])
+    assert np.allclose(across.GetColumn('SORIGINAL'), across.GetColumn('S'))
+    assert np.allclose(across[3:].GetColumn('S'), [0.5, 1.0, 2.0, 2.5, 3.0])
+    assert np.allclose(pymadx.Data.Concatenate([twiss, twiss], offsetS=False).GetColumn('S')[8:],
+                       twiss.GetColumn('S'))
+    with pytest.raises(ValueError):
+        pymadx.Data.Concatenate([twiss, pymadx.Data.Tfs(['* NAME X\n', '$ %s %le\n', ' "A" 1.0\n'])])
+
+def test_Load_from_iterable_of_lines(twiss):
+    # a generator can't be rewound so this checks the file is read once
+    lines = (line.encode() for line in _TWISS.splitlines(True))
+    streamed = pymadx.Data.Tfs(lines)
+    assert streamed.sequence == twiss.sequence
+    assert np.array_equal(streamed.GetColumn('BETX'), twiss.GetColumn('BETX'))
+
+def test_Load_compressed(twissfile, twiss, tmpdir):
+    gz = str(tmpdir.join("twiss.gz"))
+    with gzip.GzipFile(gz, 'wb') as f:
+        f.write(_TWISS.encode())
+    bz = str(tmpdir.join("twiss.tfs")) + ".bz2"
+    with open(bz, 'wb') as f:
+        f.write(bz2.compress(_TWISS.encode()))
+    tar = str(tmpdir.join("twiss.archive"))
+    with tarfile.open(tar, 'w:gz') as f:
+        f.add(twissfile, 'first.tfs')
+        f.add(twissfile, 'second.tfs')
+    for t in [pymadx.Data.Tfs(gz), pymadx.Data.Tfs(bz), pymadx.Data.Tfs(tar),
+              pymadx.Data.Tfs(tar, member='second.tfs')]:
+        assert t.sequence == twiss.sequence
+        assert np.array_equal(t.GetColumn('BETX'), twiss.GetColumn('BETX'))
+    with pytest.raises(IOError):
+        pymadx.Data.Tfs(tar, member='third.tfs')
+
+def test_Load_types_from_format_line():
+    lines = ['* NAME  NUMBER  X\n',
+             '$ %s    %d      %le\n',
+             ' "1"    3       1e-3\n',
+             ' "2"    4       -2.5\n']
+    t = pymadx.Data.Tfs(lines)
+    assert list(t.GetColumn('NAME')) == ['1', '2'] # strings stay strings
+    assert t.GetColumn('NUMBER').dtype == np.int64
+    assert np.array_equal(t.GetColumn('X'), [1e-3, -2.5])
+
+def test_Load_mangles_duplicate_names():
+    names = ['D', 'D', 'D_1', 'D', 'Q', 'D']
+    lines = ['* NAME  X\n', '$ %s  %le\n'] + [' "{}" 1.0\n'.format(n) for n in names]
+    t = pymadx.Data.Tfs(lines)
+    assert t.sequence == ['D', 'D_1', 'D_1_1', 'D_2', 'Q', 'D_3']
+    many = pymadx.Data.Tfs(lines[:2] + [' "M" 0.0\n']*20000)
+    assert many.sequence[-1] == 'M_19999'
+
+def test_Load_raises_for_wrong_number_of_items():
+    with pytest.raises(ValueError):
+        pymadx.Data.Tfs(['* NAME  X\n', '$ %s  %le\n', ' "A"  1.0  2.0\n'])
+
+def test_Load_path_like(twissfile, twiss):
+    for filename in [pathlib.Path(twissfile), py.path.local(twissfile), u'' + twissfile]:
+        t = pymadx.Data.Tfs(filename)
+        assert t.sequence == twiss.sequence
+        assert t.filename == twissfile
+        assert pymadx.Data.CheckItsTfs(filename).sequence == twiss.sequence
+        assert len(list(pymadx.Data.TfsReader(filename).IterChunks(3))) == 3
+
+def test_Load_lazy(twissfile, twiss):
+    lazy = pymadx.Data.Tfs(twissfile, lazy=True)
+    assert 'K1L' not in dict(lazy._columndata)
+    assert np.array_equal(lazy.GetColumn('K1L'), twiss.GetColumn('K1L'))
+    assert 'K1L' in dict(lazy._columndata)
+    assert 'HKICK' not in dict(lazy._columndata)
+    assert lazy.sequence == twiss.sequence
+    assert lazy.columns == twiss.columns
+    for column in twiss.columns:
+        assert list(lazy.GetColumn(column)) == list(twiss.GetColumn(column))
+
+def test_Load_lazy_sigma(twissfile, twiss):
+    lazy = pymadx.Data.Tfs(twissfile, lazy=True)
+    for column in ['SIGMAX', 'SIGMAXP', 'BETX', 'ALFX', 'DX', 'DPX']:
+        assert column not in dict(lazy._columndata)
+    assert np.array_equal(lazy.GetColumn('SIGMAX'), twiss.GetColumn('SIGMAX'))
+    assert 'BETX' not in dict(lazy._columndata)
+
+def test_Load_lazy_utf8(tmpdir):
+    f = tmpdir.join("utf8.tfs")
+    f.write_binary(u'* NAME  X\n$ %s  %le\n "ST\u00c4RT"  1.0\n'.encode('utf-8'))
+    for lazy in [False, True]:
+        assert pymadx.Data.Tfs(str(f), lazy=lazy).GetColumn('NAME')[0] == u'ST\u00c4RT'
+
+def test_Load_lazy_selections(twissfile, twiss):
+    lazy = pymadx.Data.Tfs(twissfile, lazy=True)
+    parts = [lazy.Query("KEYWORD == 'QUADRUPOLE'"), lazy.Select([1, 2]),
+             lazy[2:5], lazy[::-1], pymadx.Data.Tfs(lazy)]
+    # only the columns the selections use are made
+    assert 'K1L' not in dict(lazy._columndata)
+    assert 'HKICK' not in dict(lazy._columndata)
+    assert np.array_equal(parts[2].GetColumn('K1L'), twiss[2:5].GetColumn('K1L'))
+    assert 'HKICK' not in dict(lazy._columndata)
+    # a column made after the selection is still copied on write
+    lazy.EditComponent(2, 'HKICK', 1.0)
+    lazy.EditComponent(2, 'VKICK', 1.0)
+    assert parts[2].GetColumn('HKICK')[0] == twiss.GetColumn('HKICK')[2]
+    for part in parts:
+        part.EditComponent(0, 'VKICK', 2.0)
+    assert lazy.GetColumn('VKICK')[2] == 1.0
+    assert parts[1].GetColumn('VKICK')[1] == twiss.GetColumn('VKICK')[2]
+
+def test_Load_lazy_raises_for_wrong_number_of_items(tmpdir):
+    f = tmpdir.join("bad.tfs")
+    f.write('* NAME  X\n$ %s  %le\n "A"  1.0\n "B"  1.0  2.0\n')
+    with pytest.raises(ValueError):
+        pymadx.Data.Tfs(str(f), lazy=True)
+
+def test_Load_columns(twissfile, twiss):
+    for lazy in [False, True]:
+        t = pymadx.Data.Tfs(twissfile, columns=['S', 'BETX'], lazy=lazy)
+        assert t.columns == ['SEGMENT', 'SEGMENTNAME', 'NAME', 'S', 'BETX',
+                             'SORIGINAL', 'SMID', 'UNIQUENAME']
+        assert t.sequence == twiss.sequence
+        assert np.array_equal(t.GetColumn('SMID'), twiss.GetColumn('SMID'))
+    t = pymadx.Data.Tfs(twissfile, columns=['BETX', 'BETY', 'DX', 'DY'])
+    assert 'SMID' not in t.columns and 'SIGMAXP' not in t.columns
+    assert np.array_equal(t.GetColumn('SIGMAX'), twiss.GetColumn('SIGMAX'))
+    with pytest.raises(ValueError):
+        pymadx.Data.Tfs(twissfile, columns=['S', 'NOTACOLUMN'])
+
+_APERTURE = """\
+* NAME   KEYWORD        S     APERTYPE   APER_1  APER_2  APER_3  APER_4
+$ %s     %s             %le   %s         %le     %le     %le     %le
+ "D"     "DRIFT"        1.0   "CIRCLE"   0.05    0.0     0.0     0.0
+ "Q"     "QUADRUPOLE"   2.0   "ELLIPSE"  0.03    0.02    0.0     0.0
+"""
+
+def test_Aperture_columns(tmpdir):
+    f = tmpdir.join("aper.tfs")
+    f.write(_APERTURE)
+    columns = ['S', 'APER_1', 'APER_2', 'APER_3', 'APER_4']
+    a = pymadx.Data.Aperture(str(f), columns=columns)
+    assert 'APERTYPE' not in a.columns and 'KEYWORD' not in a.columns
+    assert np.array_equal(a.GetColumn('APER_2'), [0.0, 0.02])
+
+def test_Aperture_without_aperture_columns(tmpdir):
+    f = tmpdir.join("aper.tfs")
+    f.write(_APERTURE)
+    for columns in [['S'], ['S', 'KEYWORD']]:
+        a = pymadx.Data.Aperture(str(f), columns=columns, quiet=True)
+        assert a.GetApertureAtS(1.5)['NAME'] == 'D'
+
+def test_Aperture_GetApertureAtS_is_a_copy(tmpdir):
+    f = tmpdir.join("aper.tfs")
+    f.write(_APERTURE)
+    a = pymadx.Data.Aperture(str(f), quiet=True)
+    row = a.GetApertureAtS(2.0)
+    assert type(row) == dict and row['APER_2'] == 0.02
+    a.EditComponent(1, 'APER_2', 0.04)
+    assert row['APER_2'] == 0.02
+    row['APER_2'] = 0.0 # a snapshot that may be changed freely
+    assert a['Q']['APER_2'] == 0.04
+
+def test_Aperture_copies_share_columns(tmpdir):
+    f = tmpdir.join("aper.tfs")
+    f.write(_APERTURE)
+    a = pymadx.Data.Aperture(str(f), quiet=True)
+    b = a.RemoveAboveValue(0.04)
+    assert b.sequence == ['Q'] and b.GetApertureAtS(2.0)['APER_1'] == 0.03
+    b.EditComponent(0, 'APER_1', 0.01)
+    assert a['Q']['APER_1'] == 0.03
+    c = a.RemoveBelowValue(1e-6, 'APER_2')
+    a.EditComponent(1, 'APER_2', 0.04)
+    assert c['Q']['APER_2'] == 0.02
+
+def test_LoadMany(twiss, tmpdir):
+    for i in range(3):
+        tmpdir.join("seed_{}.tfs".format(i)).write(_TWISS.replace("2544.0", str(i+1)))
+    pattern = str(tmpdir.join("seed_*.tfs"))
+    for nworkers in [1, 2]:
+        twisses = pymadx.Data.LoadMany(pattern, nworkers=nworkers, columns=['S', 'BETX'])
+        assert [t.header['GAMMA'] for t in twisses] == [1.0, 2.0, 3.0]
+        for t in twisses:
+            assert t.sequence == twiss.sequence
+            assert np.array_equal(t.GetColumn('BETX'), twiss.GetColumn('BETX'))
+            assert 'BETY' not in t.columns
+
+_TRACK = """\
+@ NAME             %07s "TRACKONE"
+* NUMBER TURN X PX Y PY T PT S E
+$ %d %d %le %le %le %le %le %le %le %le
+#segment 1 1 3 0 start
+ 1 0 1e-3 0 0 0 0 0 0 1
+ 2 0 2e-3 0 0 0 0 0 0 1
+ 3 0 3e-3 0 0 0 0 0 0 1
+#segment 2 2 3 1 end
+ 1 0 4e-3 0 0 0 0 0 10 1
+ 2 0 5e-3 0 0 0 0 0 10 1
+ 3 0 6e-3 0 0 0 0 0 10 1
+"""
+
+def test_TfsReader_IterChunks(twissfile, twiss):
+    reader = pymadx.Data.TfsReader(twissfile)
+    assert reader.columns == twiss.columns[:len(reader.columns)]
+    chunks = list(reader.IterChunks(3))
+    assert [len(c) for c in chunks] == [3, 3, 2]
+    for column in ['BETX', 'SMID', 'SIGMAX']:
+        joined = np.concatenate([c.GetColumn(column) for c in chunks])
+        assert np.allclose(joined, twiss.GetColumn(column))
+    # the file is opened again for a second pass
+    assert len(list(reader.IterChunks(100))) == 1
+
+def test_TfsReader_IterSegments():
+    reader = pymadx.Data.TfsReader(_TRACK.splitlines(True))
+    segments = list(reader.IterSegments())
+    assert [s.segments for s in segments] == [['start'], ['end']]
+    assert np.allclose(segments[1].GetColumn('X'), [4e-3, 5e-3, 6e-3])
+    assert list(segments[1].GetColumn('SEGMENT')) == [2, 2, 2]
+    with pytest.raises(ValueError):
+        list(reader.IterChunks(2))
+
+def test_TfsReader_IterSegments_empty_segment():
+    lines = _TRACK.splitlines(True)
+    lines = lines[:7] + ['#segment 2 3 0 1 middle\n'] + lines[7:]
+    segments = list(pymadx.Data.TfsReader(lines).IterSegments())
+    assert [s.segments for s in segments] == [['start'], ['middle'], ['end']]
+    assert len(segments[1]) == 0 and segments[1].smax == 0
+    assert len(segments[2]) == 3
+
+def test_Load_cache_tar_members(twissfile, tmpdir):
+    directory = pymadx._Cache._cacheDirectory
+    pymadx.Data.SetCacheDirectory(str(tmpdir.join("cache")))
+    try:
+        other = tmpdir.join("other.tfs")
+        other.write(_TWISS.replace('"QF"', '"QX"'))
+        tar = str(tmpdir.join("twiss.tar"))
+        with tarfile.open(tar, 'w') as f:
+            f.add(twissfile, 'a.tfs')
+            f.add(str(other), 'b.tfs')
+        for member in ['a.tfs', 'b.tfs', 'a.tfs', 'b.tfs']:
+            t = pymadx.Data.Tfs(tar, member=member, cache=True)
+            assert t.sequence[2] == ('QF' if member == 'a.tfs' else 'QX')
+        assert len(tmpdir.join("cache").listdir()) == 2
+    finally:
+        pymadx.Data.SetCacheDirectory(directory)
+
+def test_Load_cache(twissfile, twiss, tmpdir):
+    directory = pymadx._Cache._cacheDirectory
+    pymadx.Data.SetCacheDirectory(str(tmpdir.join("cache")))
+    try:
+        pymadx.Data.Tfs(twissfile, cache=True)
+        cached = pymadx.Data.Tfs(twissfile, cache=True)
+        assert len(tmpdir.join("cache").listdir()) == 1
+        assert cached.sequence == twiss.sequence
+        assert cached.header == twiss.header
+        assert isinstance(cached.GetColumn('BETX').base, np.memmap)
+        for column in twiss.columns:
+            assert list(cached.GetColumn(column)) == list(twiss.GetColumn(column))
+        # edits are copy on write and don't reach the cache
+        cached.EditComponent(0, 'BETX', 99.0)
+        assert pymadx.Data.Tfs(twissfile, cache=True)[0]['BETX'] == 10.0
+        # least recently used entries are removed beyond the maximum size
+        other = tmpdir.join("other.tfs")
+        other.write(_TWISS)
+        pymadx.Data.SetCacheMaxSize(1)
+        pymadx.Data.Tfs(str(other), cache=True)
+        assert tmpdir.join("cache").listdir() == []
+    finally:
+        pymadx.Data.SetCacheMaxSize(2*1024**3)
+        pymadx.Data.SetCacheDirectory(directory)